@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from demystify import parse
+from demystify.config import EXPCONFIG
+
+
+# Stands in for conjure and savilerow, which take seconds to start
+def fake_tools(eprime, eprimeparam, dimacs):
+    fake_tools.calls += 1
+    with open(dimacs, "w") as f:
+        f.write("p cnf 1 1\n1 0\n")
+    return {"param": 1}
+
+
+class EssenceCacheTester(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.olddir = EXPCONFIG["essenceCacheDir"]
+        EXPCONFIG["essenceCacheDir"] = os.path.join(self.dir.name, "cache")
+        self.eprime = os.path.join(self.dir.name, "model.eprime")
+        self.param = os.path.join(self.dir.name, "model.param")
+        for (name, text) in ((self.eprime, "language ESSENCE' 1.0\n"), (self.param, "letting n be 1\n")):
+            with open(name, "w") as f:
+                f.write(text)
+        fake_tools.calls = 0
+
+    def tearDown(self):
+        EXPCONFIG["essenceCacheDir"] = self.olddir
+        self.dir.cleanup()
+
+    def test_hit(self):
+        with mock.patch.object(parse, "run_essence_tools", fake_tools):
+            first = parse.cached_essence_tools(self.eprime, self.param)
+            second = parse.cached_essence_tools(self.eprime, self.param)
+        self.assertEqual(fake_tools.calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(second[0], {"param": 1})
+        with open(second[1]) as f:
+            self.assertEqual(f.read(), "p cnf 1 1\n1 0\n")
+        # Nothing is left behind next to the inputs, or half-written
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["cache", "model.eprime", "model.param"])
+        self.assertEqual(len(os.listdir(EXPCONFIG["essenceCacheDir"])), 1)
+
+    def test_key(self):
+        key = parse.essence_cache_key(self.eprime, self.param)
+        with open(self.param, "a") as f:
+            f.write("letting m be 2\n")
+        self.assertNotEqual(parse.essence_cache_key(self.eprime, self.param), key)
@@ -0,0 +1,62 @@
+import logging
+import unittest
+from demystify.base import EqVal, Puzzle, VarMatrix
+from demystify.buildpuz import alldiffRowsCols
+from demystify.config import EXPCONFIG
+from demystify.explain import Explainer
+from Tests.test_internal import cnfSolver
+
+
+# A 4x4 latin square, with enough given to have one solution
+def latinExplainer(**kwargs):
+    square = [[1, 2, 3, 4], [3, 4, 1, 2], [2, 1, 4, 3], [4, 3, 2, 1]]
+    vars = VarMatrix(lambda t: (t[0] + 1, t[1] + 1), (4, 4), [1, 2, 3, 4])
+    puz = Puzzle([vars])
+    puz.addConstraints(alldiffRowsCols(vars))
+    solver = cnfSolver(puz)
+    for (i, j) in [(0, 0), (0, 1), (1, 0), (1, 3), (2, 2), (3, 3)]:
+        solver.addLit(EqVal(vars[i][j], square[i][j]))
+    exp = Explainer("cascade", **kwargs)
+    exp.config["cores"] = 1
+    exp.puzzle, exp.solver, exp.params, exp.name = puz, solver, {}, "latin"
+    exp.solution = exp._get_puzzle_solution()
+    exp.unexplained = [p for p in exp.solution if p not in solver.getKnownLits()]
+    exp._set_mus_finder()
+    return exp
+
+
+class PipelineTester(unittest.TestCase):
+    def test_same_steps(self):
+        expected = latinExplainer().explain_steps()
+        exp = latinExplainer(pipeline=True)
+        with self.assertLogs(level=logging.INFO) as logs:
+            self.assertEqual(exp.explain_steps(), expected)
+        self.assertTrue(any("Using lookahead" in l for l in logs.output))
+
+    def test_discard(self):
+        exp = latinExplainer(pipeline=True)
+        exp._start_lookahead(exp.unexplained[:1])
+        proc = exp._lookahead[0]
+        # Not what the lookahead was looking for
+        self.assertIsNone(exp._finish_lookahead(exp.unexplained))
+        self.assertIsNone(exp._lookahead)
+        self.assertFalse(proc.is_alive())
+
+    def test_cancel(self):
+        exp = latinExplainer(pipeline=True)
+        exp._start_lookahead(exp.unexplained[:1])
+        proc = exp._lookahead[0]
+        exp.cancel_lookahead()
+        self.assertIsNone(exp._lookahead)
+        self.assertFalse(proc.is_alive())
+        exp.cancel_lookahead()
+
+    def test_not_forked(self):
+        exp = latinExplainer(pipeline=True)
+        old = EXPCONFIG["poolStartMethod"]
+        try:
+            EXPCONFIG["poolStartMethod"] = "spawn"
+            exp._start_lookahead(exp.unexplained[:1])
+        finally:
+            EXPCONFIG["poolStartMethod"] = old
+        self.assertIsNone(exp._lookahead)
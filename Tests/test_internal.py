@@ -0,0 +1,59 @@
+import unittest
+from itertools import combinations
+from pysat.formula import CNF
+from demystify.base import EqVal, NeqVal, Puzzle, VarMatrix
+from demystify.buildpuz import buildLess, buildNeq
+from demystify.internal import Solver
+
+
+# Build a CNF Solver for 'puz', with one SAT variable for each EqVal and
+# one selector for each constraint
+def cnfSolver(puz):
+    cnf = CNF()
+    litmap = {}
+    conmap = {}
+    for mat in puz.vars():
+        for v in mat.varlist():
+            for d in v.dom():
+                litmap[EqVal(v, d)] = cnf.nv + 1
+                cnf.nv += 1
+
+    def tosat(lit):
+        return litmap[lit] if lit.equal else -litmap[lit.neg()]
+
+    cons = [c for mat in puz.vars() for c in mat.constraints()] + list(puz.constraints())
+    for c in cons:
+        cnf.nv += 1
+        for clause in c.clauseset():
+            cnf.append([tosat(l) for l in clause] + [-cnf.nv])
+        conmap[c] = cnf.nv
+    return Solver(puz, cnf=cnf, litmap=litmap, conmap=conmap)
+
+
+# Three different values from 1..3, where the first is less than the second.
+# There are three solutions: 123, 132 and 231.
+def orderedRow():
+    vars = VarMatrix(lambda t: "x" + str(t[1]), (1, 3), [1, 2, 3])
+    puz = Puzzle([vars])
+    for (a, b) in combinations(vars.varlist(), 2):
+        puz.addConstraints(buildNeq("in the row", a, b, [1, 2, 3]))
+    puz.addConstraints(buildLess(vars[0][0], vars[0][1], [1, 2, 3]))
+    return (vars, puz)
+
+
+class BackboneTester(unittest.TestCase):
+    def test_backbone(self):
+        (vars, puz) = orderedRow()
+        backbone = cnfSolver(puz).solveAll([])
+        self.assertIn(NeqVal(vars[0][0], 3), backbone)
+        self.assertIn(NeqVal(vars[0][1], 1), backbone)
+        self.assertNotIn(EqVal(vars[0][0], 1), backbone)
+        self.assertNotIn(NeqVal(vars[0][0], 1), backbone)
+
+    def test_parallel_backbone(self):
+        (vars, puz) = orderedRow()
+        solver = cnfSolver(puz)
+        self.assertEqual(
+            solver._solveAllParallel([], 2), solver._solveAll([])
+        )
+        self.assertEqual(solver.solveAll([], cores=2), solver.solveAll([]))
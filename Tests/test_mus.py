@@ -0,0 +1,145 @@
+import unittest
+from sortedcontainers import SortedSet
+from demystify.mus import quickXplain, modelRotation, reminimiseMUS
+from demystify.solvers.pysatimpl import SATSolver
+
+
+# Pretends to be a SAT solver, where a set of literals is unsat exactly when
+# it contains one of 'cores'
+class CoreOracle:
+    def __init__(self, cores):
+        self.cores = [set(c) for c in cores]
+        self.calls = 0
+
+    def basicCore(self, lits):
+        self.calls += 1
+        if any(c.issubset(lits) for c in self.cores):
+            return list(lits)
+        return None
+
+
+class QuickXplainTester(unittest.TestCase):
+    def test_finds_mus(self):
+        oracle = CoreOracle([[3, 17, 42]])
+        mus = quickXplain(oracle, [], list(range(100)), 10)
+        self.assertEqual(sorted(mus), [3, 17, 42])
+
+    def test_result_is_minimal(self):
+        oracle = CoreOracle([[1, 2, 3, 4], [50, 60], [2, 70]])
+        mus = quickXplain(oracle, [], list(range(100)), 10)
+        self.assertIn(sorted(mus), [[1, 2, 3, 4], [50, 60], [2, 70]])
+
+    def test_background_assumptions(self):
+        # -1 is always passed to the solver, but never returned
+        oracle = CoreOracle([[-1, 5, 6]])
+        mus = quickXplain(oracle, [-1], list(range(2, 50)), 10)
+        self.assertEqual(sorted(mus), [5, 6])
+
+    def test_maxsize(self):
+        oracle = CoreOracle([list(range(0, 40, 4))])
+        self.assertIsNone(quickXplain(oracle, [], list(range(50)), 5))
+        self.assertEqual(len(quickXplain(oracle, [], list(range(50)), 10)), 10)
+
+    def test_few_calls(self):
+        oracle = CoreOracle([[10, 900]])
+        quickXplain(oracle, [], list(range(1000)), 10)
+        self.assertLess(oracle.calls, 60)
+
+    def test_cancel(self):
+        oracle = CoreOracle([[10, 900]])
+        self.assertIsNone(quickXplain(oracle, [], list(range(1000)), 10, cancel=lambda: True))
+
+
+# A constraint, given by its clauses of variable names
+class FakeCon:
+    def __init__(self, name, clauses):
+        self.name = name
+        self.clauses = clauses
+
+    def clauseset(self):
+        return self.clauses
+
+
+# A CoreOracle with the id maps reminimiseMUS needs, which returns just the
+# core it finds. The only lit id is 0, for "-p".
+class FakeMUSSolver(CoreOracle):
+    def __init__(self, cores, cons, known):
+        super().__init__(cores)
+        self.known = known
+        self._idsmt = ["-p"]
+        self._idcons = cons
+        self._conidsels = [c.name for c in cons]
+        self._selconids = {c.name: i for (i, c) in enumerate(cons)}
+
+    def basicCore(self, lits):
+        self.calls += 1
+        for c in self.cores:
+            if c.issubset(lits):
+                return [l for l in lits if l in c]
+        return None
+
+    def getKnownLits(self):
+        return self.known
+
+
+class ReminimiseTester(unittest.TestCase):
+    # A (id 0) is (V or x) and (V -> p), C (id 1) is (x -> p). {A, C} is a
+    # MUS for p.
+    A = FakeCon("A", [["V", "x"], ["-V", "p"]])
+    C = FakeCon("C", [["-x", "p"]])
+
+    def test_unchanged(self):
+        # Nothing new is known, so one SAT call checks the MUS
+        solver = FakeMUSSolver([["-p", "A", "C"]], [self.A, self.C], [])
+        self.assertEqual(reminimiseMUS(solver, [0], [0, 1]), [0, 1])
+        self.assertEqual(solver.calls, 1)
+
+    def test_untouched_constraint_removed(self):
+        # Once V is known A proves p alone, so C must go even though it
+        # does not mention V
+        solver = FakeMUSSolver([["-p", "A"]], [self.A, self.C], ["V"])
+        self.assertEqual(reminimiseMUS(solver, [0], [0, 1]), [0])
+
+    def test_satisfied_constraint_removed(self):
+        # Once x is known false, C is satisfied
+        solver = FakeMUSSolver([["-p", "A"]], [self.A, self.C], ["-x", "V"])
+        self.assertEqual(reminimiseMUS(solver, [0], [0, 1]), [0])
+
+
+class FakeSolver:
+    def __init__(self, clauses, conlits):
+        self._solver = SATSolver()
+        for c in clauses:
+            self._solver.addConstraint(c)
+        self._conlits = SortedSet(conlits)
+
+
+class ModelRotationTester(unittest.TestCase):
+    # x (1) and y (2), with constraints 3: x, 4: x -> y, 5: not y
+    clauses = [[1, -3], [-1, 2, -4], [-2, -5]]
+
+    def test_chain(self):
+        solver = FakeSolver(self.clauses, [3, 4, 5])
+        # Constraint 3 is off, x and y are false
+        model = [-1, -2, -3, 4, 5]
+        self.assertEqual(modelRotation(solver, model, 3, [3, 4, 5], []), {4, 5})
+
+    def test_known(self):
+        solver = FakeSolver(self.clauses, [3, 4, 5])
+        model = [-1, -2, -3, 4, 5]
+        self.assertEqual(modelRotation(solver, model, 3, [3, 4, 5], [], {4}), set())
+
+    def test_fixed(self):
+        # We cannot flip y, as it is assumed false
+        solver = FakeSolver(self.clauses, [3, 4, 5])
+        model = [-1, -2, -3, 4, 5]
+        self.assertEqual(modelRotation(solver, model, 3, [3, 4, 5], [-2]), {4})
+
+    def test_not_critical(self):
+        # With a second copy of 'x' (6), constraint 3 is not needed in the
+        # core. Rotate from a real model with the rest of the core on.
+        solver = FakeSolver(self.clauses + [[1, -6]], [3, 4, 5, 6])
+        sol = solver._solver.solve([4, 5, -6], getsol=True)
+        model = [v if sol[v] else -v for v in range(1, 7)]
+        self.assertEqual(model[:3], [-1, -2, -3])
+        self.assertEqual(modelRotation(solver, model, 6, [4, 5, 6], []), {4, 5})
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from pysat.formula import CNF
+from demystify.base import DummyClause, EqVal, NeqVal, Var
+from demystify.config import EXPCONFIG
+from demystify.muscache import MUSCache
+from demystify.musdict import MusDict
+
+
+# Just enough of internal.Solver for the cache: two literals, and
+# two constraints which each prove the first one. 'lits' and 'cons' are the
+# ids of these, which is what MusDicts hold.
+class FakeSolver:
+    def __init__(self):
+        v = Var("x", [1, 2], (0, 0))
+        self.varlits = [EqVal(v, 1), EqVal(v, 2), NeqVal(v, 1), NeqVal(v, 2)]
+        self._idsmt = [1, 2, -1, -2]
+        self._varlit2smtmap = dict(zip(self.varlits, self._idsmt))
+        self.lits = [0, 1]
+        self._conmap = {
+            3: DummyClause("a", [self.varlits[0]]),
+            4: DummyClause("b", [self.varlits[3]]),
+        }
+        self._conidsels = [3, 4]
+        self._selconids = {3: 0, 4: 1}
+        self.cons = [0, 1]
+        self._cnf = CNF(from_clauses=[[1, -3], [-2, -4], [1, 2]])
+        self.known = []
+        self.valid = True
+        self.calls = 0
+
+    def negLitId(self, i):
+        return (i + 2) % 4
+
+    def getKnownLits(self):
+        return self.known
+
+    def basicCore(self, lits):
+        self.calls += 1
+        return lits if self.valid else None
+
+
+class MUSCacheTester(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.olddir = EXPCONFIG["musCacheDir"]
+        EXPCONFIG["musCacheDir"] = self.dir.name
+
+    def tearDown(self):
+        EXPCONFIG["musCacheDir"] = self.olddir
+        self.dir.cleanup()
+
+    def makeDict(self, solver):
+        musdict = MusDict({})
+        musdict.update(solver.lits[0], [solver.cons[0]])
+        musdict.update(solver.lits[0], [solver.cons[1]])
+        return musdict
+
+    def test_roundtrip(self):
+        solver = FakeSolver()
+        cache = MUSCache(solver, "cascade", {})
+        self.assertIsNone(cache.lookup(solver.lits))
+        musdict = self.makeDict(solver)
+        cache.store(solver.lits, musdict)
+        # A different run, with a new cache object
+        cache = MUSCache(solver, "cascade", {})
+        self.assertEqual(cache.lookup(solver.lits), musdict)
+        self.assertEqual(solver.calls, 1)
+
+    def test_key(self):
+        solver = FakeSolver()
+        MUSCache(solver, "cascade", {}).store(solver.lits, self.makeDict(solver))
+        self.assertIsNone(MUSCache(solver, "forqes", {}).lookup(solver.lits))
+        self.assertIsNone(MUSCache(solver, "cascade", {"a": 1}).lookup(solver.lits))
+        self.assertIsNone(MUSCache(solver, "cascade", {}).lookup(solver.lits[:1]))
+        solver.known = [solver.varlits[3]]
+        self.assertIsNone(MUSCache(solver, "cascade", {}).lookup(solver.lits))
+
+    def test_invalid(self):
+        solver = FakeSolver()
+        cache = MUSCache(solver, "cascade", {})
+        cache.store(solver.lits, self.makeDict(solver))
+        solver.valid = False
+        self.assertIsNone(cache.lookup(solver.lits))
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_evict(self):
+        solver = FakeSolver()
+        cache = MUSCache(solver, "cascade", {})
+        oldsize = EXPCONFIG["musCacheSize"]
+        try:
+            EXPCONFIG["musCacheSize"] = 0
+            cache.store(solver.lits, self.makeDict(solver))
+        finally:
+            EXPCONFIG["musCacheSize"] = oldsize
+        self.assertEqual(os.listdir(self.dir.name), [])
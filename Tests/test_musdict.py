@@ -109,3 +109,50 @@ class MusDictTester(unittest.TestCase):
                              lits), DummyClause('cols 1 and 2 must be different',
                                                 lits))]
         self.assertEqual(testdict.minimum(), 2)
+
+
+class LitTester(unittest.TestCase):
+    def test_pickle(self):
+        import pickle
+        v = Var('grid[1,2]', [1, 2], (1, 2))
+        lit = Lit(v, 2, False)
+        clause = DummyClause('c', [lit, Lit(v, 1, False)])
+        (lit2, clause2) = pickle.loads(pickle.dumps((lit, clause)))
+        self.assertEqual(lit2, lit)
+        self.assertEqual(hash(lit2), hash(lit))
+        self.assertEqual(clause2, clause)
+        self.assertEqual(clause2.lits(), clause.lits())
+        self.assertEqual({lit: 1}[lit2.neg().neg()], 1)
+
+    def test_old_pickle(self):
+        import pickle
+
+        # Pickles the way these classes did before they had __slots__
+        class Old:
+            def __init__(self, cls, state):
+                self.cls = cls
+                self.state = state
+
+            def __reduce__(self):
+                return (object.__new__, (self.cls,), self.state)
+
+        v = Var('grid[1,2]', [1, 2], (1, 2))
+        lit = Lit(v, 2, False)
+        clause = DummyClause('c', [lit])
+        oldv = Old(Var, {'_dom': v._dom, '_name': v._name, '_location': v._location})
+        oldlit = Old(Lit, {'var': oldv, 'val': 2, 'equal': False})
+        oldclause = Old(DummyClause, (None, {
+            '_name': 'c', '_clause': [oldlit], '_clausenames': None,
+            '_frozen': ((oldlit,),), '_lits': (oldlit,)}))
+        (v2, lit2, clause2) = pickle.loads(pickle.dumps((oldv, oldlit, oldclause)))
+        self.assertEqual(v2, v)
+        self.assertEqual(lit2, lit)
+        self.assertEqual(hash(lit2), hash(lit))
+        self.assertEqual(clause2, clause)
+        self.assertEqual(clause2.lits(), (lit,))
+
+    def test_order(self):
+        a = Var('a', [1, 2], (0, 0))
+        b = Var('b', [1, 2], (0, 1))
+        lits = [Lit(b, 1, True), Lit(a, 2, True), Lit(a, 1, True), Lit(a, 1, False)]
+        self.assertEqual(sorted(lits), [Lit(a, 1, False), Lit(a, 1, True), Lit(a, 2, True), Lit(b, 1, True)])
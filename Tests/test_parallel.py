@@ -0,0 +1,105 @@
+import unittest
+from demystify.config import EXPCONFIG
+from demystify.parallel import guidedBatches, ProcessPool, getChildSolver, setChildSolver
+from demystify.parallel import getPublishedSolver, unpublish
+
+
+class StatsOnly:
+    known = []
+
+    def knownLitIds(self):
+        return list(self.known)
+
+    def setKnownLitIds(self, ids):
+        self.known = ids
+
+    def reset_stats(self):
+        pass
+
+    def get_stats(self):
+        return {}
+
+    def add_stats(self, d):
+        pass
+
+
+def square(x):
+    return x * x
+
+
+def childTotal(x):
+    return getChildSolver().total + x
+
+
+def childKnown(x):
+    return getChildSolver().known
+
+
+class ParallelTester(unittest.TestCase):
+    def test_guided_batches_cover(self):
+        for n in [0, 1, 7, 100, 713]:
+            batches = guidedBatches(n, 4, 4)
+            self.assertEqual(sum(e - s for (s, e) in batches), n)
+            self.assertEqual([s for (s, _) in batches[1:]], [e for (_, e) in batches[:-1]])
+
+    def test_guided_batches_shrink(self):
+        sizes = [e - s for (s, e) in guidedBatches(1000, 8, 4)]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(sizes[-1], 1)
+
+    def test_pool_map(self):
+        setChildSolver(StatsOnly())
+        args = list(range(200))
+        with ProcessPool(processes=3) as pool:
+            res = pool.map(square, args)
+        # Results line up with the (shuffled) argument list
+        self.assertEqual(res, [x * x for x in args])
+        self.assertEqual(sorted(args), list(range(200)))
+
+    def test_pool_spawn(self):
+        solver = StatsOnly()
+        solver.total = 100
+        setChildSolver(solver)
+        old = EXPCONFIG["poolStartMethod"]
+        try:
+            EXPCONFIG["poolStartMethod"] = "spawn"
+            with ProcessPool(processes=2) as pool:
+                # The workers have their own copy of the solver
+                solver.total = 0
+                res = pool.map(childTotal, list(range(10)))
+        finally:
+            EXPCONFIG["poolStartMethod"] = old
+            unpublish()
+        self.assertEqual(sorted(res), list(range(100, 110)))
+
+    def test_published_once(self):
+        solver = StatsOnly()
+        try:
+            name = getPublishedSolver(solver).name
+            self.assertEqual(getPublishedSolver(solver).name, name)
+            self.assertNotEqual(getPublishedSolver(StatsOnly()).name, name)
+        finally:
+            unpublish()
+
+    def test_pool_known(self):
+        # Workers which outlive the state they were started with are sent
+        # the known literals
+        for (method, reuse) in [("fork", True), ("spawn", False)]:
+            solver = StatsOnly()
+            solver.total = 0
+            setChildSolver(solver)
+            old = EXPCONFIG["poolStartMethod"]
+            try:
+                EXPCONFIG["poolStartMethod"] = method
+                pool = ProcessPool(processes=2, reuse=reuse)
+                with pool:
+                    solver.known = [1, 2]
+                    self.assertEqual(pool.map(childKnown, list(range(10))), [[1, 2]] * 10)
+                if reuse:
+                    with pool:
+                        solver.known = [3]
+                        self.assertEqual(pool.map(childKnown, list(range(10))), [[3]] * 10)
+                    pool.cleanup()
+            finally:
+                EXPCONFIG["poolStartMethod"] = old
+                unpublish()
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from pysat.formula import CNF
+from sortedcontainers import SortedSet
+from demystify.snapshot import SnapshotError, load_snapshot, save_snapshot
+from demystify.solvers.pysatimpl import SATSolver
+
+
+class SnapshotTester(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "snap")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_solver(self):
+        solver = SATSolver(CNF(from_clauses=[[1, 2], [-1, -2], [2, 3]]))
+        solver.addLit(-3)
+        save_snapshot({"solver": solver, "set": SortedSet([3, 1, 2])}, self.path)
+        # Saving must not break the original
+        self.assertEqual(solver.solve([], getsol=True), {1: False, 2: True, 3: False})
+
+        loaded = load_snapshot(self.path)
+        self.assertEqual(list(loaded["set"]), [1, 2, 3])
+        loaded["set"].add(0)
+        self.assertEqual(list(loaded["set"]), [0, 1, 2, 3])
+        newsolver = loaded["solver"]
+        self.assertEqual(newsolver.solve([], getsol=True), {1: False, 2: True, 3: False})
+        self.assertFalse(newsolver.solve([1], getsol=False))
+        # Solving doesn't need the clause lists
+        self.assertNotIn("_clauses", newsolver.__dict__)
+        self.assertEqual(newsolver._clauses, [[1, 2], [-1, -2], [2, 3]])
+
+    def test_old_solver_state(self):
+        # Older versions pickled the clause lists, the deleted pysat solver
+        # and fewer stats
+        solver = SATSolver(CNF(from_clauses=[[1, 2], [-1, -2], [2, 3]]))
+        d = solver.__dict__.copy()
+        for name in ("_occurs", "_recentprops", "_watchcalls"):
+            del d[name]
+        d["_stats"] = {"solveCount": 3, "solveTime": 0}
+        d["_solver"].delete()
+        old = SATSolver.__new__(SATSolver)
+        old.__setstate__(d)
+        self.assertEqual(old.solve([], getsol=True), {1: False, 2: True, 3: False})
+        self.assertEqual(old.get_stats()["solveCount"], 4)
+        self.assertEqual(old.get_stats()["solveUnknown"], 0)
+
+    def test_bad_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot")
+        with self.assertRaises(SnapshotError):
+            load_snapshot(self.path)
@@ -3,5 +3,8 @@ import os
 if os.name != 'nt':
     import multiprocessing
 
-    multiprocessing.set_start_method('fork')
-    assert multiprocessing.get_start_method() == 'fork'
+    # Pools choose how to start their workers (EXPCONFIG["poolStartMethod"]).
+    # Workers started by spawn or forkserver import us again, and already
+    # have a start method.
+    if multiprocessing.get_start_method(allow_none=True) is None:
+        multiprocessing.set_start_method('fork')
@@ -13,6 +13,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
 import demystify
 import demystify.explain
+import demystify.snapshot
 
 parser = argparse.ArgumentParser(description="Demystify")
 
@@ -88,6 +89,25 @@ parser.add_argument(
     help="optional JSON file output",
 )
 
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="Write JSON output one line per step, as each step is found (the first line has the puzzle name and params)",
+)
+
+parser.add_argument(
+    "--pipeline",
+    action="store_true",
+    help="Start looking for the next step's MUSes while each step is output",
+)
+
+parser.add_argument(
+    "--aggregate",
+    type=str,
+    default=None,
+    help="Convert a file written with --stream into the normal JSON output, then exit",
+)
+
 parser.add_argument(
     "--forqes",
     action="store_true",
@@ -95,23 +115,55 @@ parser.add_argument(
     help="Use the FORQES algorithm for MUS finding",
 )
 
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="Run the SAT solver in incremental mode",
+)
+
+parser.add_argument(
+    "--muscache",
+    type=str,
+    default=None,
+    help="Directory to store MUSes in, to reuse when a puzzle is run again",
+)
+
+parser.add_argument(
+    "--essencecache",
+    type=str,
+    default=None,
+    help="Directory to store savilerow output in, to reuse when a puzzle is run again",
+)
+
 parser.add_argument(
     '--pickle',
     type=str,
     default=None,
-    help="After building puzzle, save as a Pickled Python object (for future loading)"
+    help="After building puzzle, save a snapshot of it (for future loading)"
 )
 
 parser.add_argument(
     '--unpickle',
     type=str,
     default=None,
-    help="Use a previously picked solver"
+    help="Use a previously saved snapshot (or pickle, from older versions)"
 )
 
 
 args = parser.parse_args()
 
+if args.json is not None:
+    output_path = args.json[0]
+else:
+    output_path = "./output" + str(int(time.time())) + ".json"
+
+if args.aggregate is not None:
+    with open(args.aggregate) as f:
+        output = demystify.explain.aggregate_stream(f)
+    with open(output_path, "w") as f:
+        f.write(json.dumps(output))
+    sys.exit(0)
+
 
 if sum([args.puzzle is not None, args.eprime is not None, args.unpickle is not None]) != 1:
     print("Must give exactly one of --puzzle or --eprime or --unpickle")
@@ -140,12 +192,21 @@ demystify.config.LoadConfigFromDict(
 if args.multiple:
     demystify.config.LoadConfigFromDict(demystify.config.CONFIG_MORE_MUS)
 
+if args.incremental:
+    demystify.config.EXPCONFIG["solverIncremental"] = True
+
+if args.muscache is not None:
+    demystify.config.EXPCONFIG["musCacheDir"] = args.muscache
+
+if args.essencecache is not None:
+    demystify.config.EXPCONFIG["essenceCacheDir"] = args.essencecache
+
 if args.forqes:
     mus_finder = "forqes"
 else:
     mus_finder = "cascade"
 
-explainer = demystify.explain.Explainer(mus_finder, skip=args.skip)
+explainer = demystify.explain.Explainer(mus_finder, skip=args.skip, pipeline=args.pipeline)
 
 if args.puzzle is not None:
     name = os.path.basename(args.puzzle)
@@ -154,20 +215,17 @@ elif args.eprime is not None:
     name = os.path.basename(args.eprime)
     explainer.init_from_essence(args.eprime, args.eprimeparam, allow_incomplete=args.incomplete)
 else: # unpickle
-    with open(args.unpickle, 'rb') as f:
-        explainer = pickle.load(f)
+    if demystify.snapshot.is_snapshot(args.unpickle):
+        explainer = demystify.snapshot.load_snapshot(args.unpickle)
+    else:
+        with open(args.unpickle, 'rb') as f:
+            explainer = pickle.load(f)
 
 if args.pickle is not None:
-    print("Picking solver to : {}".format(args.pickle))
-    with open(args.pickle, 'wb') as f:
-        pickle.dump(explainer, f)
+    print("Saving snapshot to : {}".format(args.pickle))
+    demystify.snapshot.save_snapshot(explainer, args.pickle)
     sys.exit(0)
 
-if args.json is not None:
-    output_path = args.json[0]
-else:
-    output_path = "./output" + str(int(time.time())) + ".json"
-
 f = open(output_path, "w")
 
 if args.force is None:
@@ -176,8 +234,18 @@ else:
     parse_args = [int(i) for i in args.force.split(",")]
     forced_args = {"row": parse_args[0], "column": parse_args[1], "value": parse_args[2]}
 
-output = explainer.explain_steps(num_steps=args.steps, lit_choice=forced_args)
+if args.stream:
+    f.write(json.dumps(explainer.output_header()) + "\n")
+    f.flush()
+    for step in explainer.iter_steps(num_steps=args.steps, lit_choice=forced_args):
+        f.write(json.dumps(step) + "\n")
+        f.flush()
+else:
+    output = explainer.explain_steps(num_steps=args.steps, lit_choice=forced_args)
+    f.write(json.dumps(output))
+
+explainer.cancel_lookahead()
 
-f.write(json.dumps(output))
+logging.info("Solver stats: %s", explainer.solver.get_stats())
 
 f.close()
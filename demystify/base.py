@@ -8,13 +8,43 @@ from .utils import flatten
 from sortedcontainers import *
 
 
+# Older versions pickled Lit, Var and DummyClause by their __dict__. Returns
+# that dict if 'state' is in one of those forms, else None.
+def _oldstate(state):
+    if isinstance(state, dict):
+        return state
+    if (
+        isinstance(state, tuple)
+        and len(state) == 2
+        and (state[0] is None or isinstance(state[0], dict))
+        and isinstance(state[1], dict)
+    ):
+        return {**(state[0] or {}), **state[1]}
+    return None
+
+
 # Represent 'var == val'
+# Lits are compared and hashed very often, so we store the key we compare by
+# (the same order as comparing (var, val, equal), as Vars compare by name)
 @functools.total_ordering
 class Lit:
+    __slots__ = ("var", "val", "equal", "_key", "_hash")
+
     def __init__(self, var, val: int, equal: bool):
         self.var = var
         self.val = val
         self.equal = equal
+        self._key = (var._name, val, equal)
+        self._hash = hash(self._key)
+
+    # Hashes of strings change between runs, so don't pickle them
+    def __reduce__(self):
+        return (Lit, (self.var, self.val, self.equal))
+
+    # Only used to load old pickles
+    def __setstate__(self, state):
+        state = _oldstate(state)
+        self.__init__(state["var"], state["val"], state["equal"])
 
     def __repr__(self) -> str:
         if self.equal:
@@ -23,21 +53,13 @@ class Lit:
             return "{} is not {}".format(self.var, self.val)
 
     def __eq__(self, other) -> bool:
-        return (self.var, self.val, self.equal) == (
-            other.var,
-            other.val,
-            other.equal,
-        )
+        return self._key == other._key
 
     def __lt__(self, other) -> bool:
-        return (self.var, self.val, self.equal) < (
-            other.var,
-            other.val,
-            other.equal,
-        )
+        return self._key < other._key
 
     def __hash__(self):
-        return (self.var, self.val, self.equal).__hash__()
+        return self._hash
 
     def neg(self):
         return Lit(self.var, self.val, not self.equal)
@@ -52,12 +74,25 @@ def NeqVal(var, val: int) -> Lit:
 
 
 class DummyClause:
+    __slots__ = ("_name", "_clause", "_clausenames", "_frozen", "_lits", "_hash")
+
     def __init__(self, name: str, clause: Sequence[str], clausenames=None):
         self._name = name
         self._clause = clause
         self._clausenames = clausenames
         self._frozen = tuple([tuple(sorted(self._clause))])
         self._lits = tuple(SortedSet(flatten(self._frozen)))
+        self._hash = hash(self._name)
+
+    def __getstate__(self):
+        return (self._name, self._clause, self._clausenames, self._frozen, self._lits)
+
+    def __setstate__(self, state):
+        old = _oldstate(state)
+        if old is not None:
+            state = tuple(old[k] for k in ("_name", "_clause", "_clausenames", "_frozen", "_lits"))
+        (self._name, self._clause, self._clausenames, self._frozen, self._lits) = state
+        self._hash = hash(self._name)
 
     def explain(self, knownvars):
         if self._clausenames is None:
@@ -83,7 +118,7 @@ class DummyClause:
         return self._name == other._name
 
     def __hash__(self):
-        return self._name.__hash__()
+        return self._hash
 
     def __lt__(self, other):
         return self._name < other._name
@@ -206,10 +241,23 @@ def cellHasValue(var, dom):
 
 @functools.total_ordering
 class Var:
+    __slots__ = ("_dom", "_name", "_location", "_hash")
+
     def __init__(self, name: str, dom: Sequence[int], location):
         self._dom = dom
         self._name = str(name)
         self._location = location
+        self._hash = hash(self._name)
+
+    def __getstate__(self):
+        return (self._dom, self._name, self._location)
+
+    def __setstate__(self, state):
+        old = _oldstate(state)
+        if old is not None:
+            state = (old["_dom"], old["_name"], old["_location"])
+        (self._dom, self._name, self._location) = state
+        self._hash = hash(self._name)
 
     def dom(self):
         return self._dom
@@ -263,7 +311,7 @@ class Var:
         return self._name < other._name
 
     def __hash__(self):
-        return self._name.__hash__()
+        return self._hash
 
 
 class VarMatrix:
@@ -10,16 +10,58 @@ EXPCONFIG = {
     "dumpSAT": False,
     # Cache MUSes between steps
     "useCache": True,
+    # Directory to store MUSes in between runs (None to disable), and
+    # the most bytes to keep there
+    "musCacheDir": None,
+    "musCacheSize": 100 * 1024 * 1024,
+    # Directory to store the output of conjure and savilerow in, so each
+    # model and parameter file is only compiled once (None to disable)
+    "essenceCacheDir": None,
     # Use same pool of solvers throughout
     "reusePool": False,
+    # How pool workers are started: "fork" (they inherit the solver), or
+    # "spawn" / "forkserver" (the solver is copied to them through shared
+    # memory, which is safe when the main process has threads). The solver
+    # is copied once, and workers are sent the known literals as they change.
+    "poolStartMethod": "fork",
+    # Pool batches start at 1/(poolBatchFactor * cores) of the jobs in a map,
+    # and shrink as the jobs run out
+    "poolBatchFactor": 4,
     # Make use of unsat cores when shrinking MUSes
     "useUnsatCores": True,
+    # Use the models from failed removals to find more constraints which
+    # must be in the MUS, without calling the solver (pysat solvers only)
+    "useModelRotation": True,
+    # Find which literals a MUS proves by unit propagation where possible,
+    # and only use full SAT calls for the rest (pysat solvers only)
+    "usePropagation": True,
+    # When finding which literals are fixed in every solution (for puzzles
+    # with many solutions), test this many candidate literals in one solve
+    "backboneChunk": 20,
     # Use 'incremental' mode in solver
     # Todo: Sometimes this makes the solver go super-slow
+    # (see eprime-tests/bench-incremental.sh to compare the two modes)
     "solverIncremental": False,
-    # Limit search to searchLimitedBudget conflicts
+    # The solver keeps learned clauses between solves, and between jobs in
+    # a pool. Every solverRebootWindow solves, check if the average
+    # propagations per solve have grown by more than solverRebootSlowdown
+    # times since the solver was (re)started, after more than
+    # solverRebootLearnts conflicts (learned clauses). If so, reboot it.
+    # This only runs in incremental mode (solverIncremental). Set
+    # solverRebootSlowdown to 0 to never reboot.
+    "solverRebootWindow": 100,
+    "solverRebootSlowdown": 4,
+    "solverRebootLearnts": 20000,
+    # Limit each search to solveLimitedBudgetMult times the average number
+    # of propagations of the last solveLimitedWindow searches which finished,
+    # but at least solveLimitedBudget and at most solveLimitedBudgetMax.
+    # When a search runs out of budget while shrinking a MUS, it is retried
+    # at the end with solveLimitedBudgetMax.
     "solveLimited": True,
     "solveLimitedBudget": 10000,
+    "solveLimitedBudgetMult": 10,
+    "solveLimitedBudgetMax": 10000000,
+    "solveLimitedWindow": 100,
     # Which solver to use (g4 = glucose), z3 = Use Z3
     "solver": "g4",
 
@@ -47,6 +89,9 @@ CONFIG_FAST = {
     "baseSizeMUS": 4,
     # Alternative, safer, MUS-finding algorithm
     "gallopingMUSes": False,
+    # Shrink MUSes by divide and conquer (QuickXplain), rather than
+    # trying to remove one constraint at a time
+    "quickXplainMUSes": False,
     # Start by chopping big bits off MUSes, to encourage variety
     "prechopMUSes12": False,
     # Start Gallops with big steps
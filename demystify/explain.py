@@ -1,14 +1,18 @@
+import json
 import logging
 import math
+import multiprocessing
 import os
+import signal
 
 from .parse import parse_json, parse_essence
-from .mus import CascadeMUSFinder, checkWhichLitsAMUSProves
+from .mus import CascadeMUSFinder, checkWhichLitsMUSesProve
 from .musforqes import ForqesMUSFinder
-from .utils import flatten, in_flattened, intsqrt, lowsqrt
+from .parallel import resetSharedInts
+from .utils import flatten, intsqrt, lowsqrt
 from .base import EqVal, NeqVal
 
-from .config import getDefaultConfig, getMoreMusConfig, getHintConfig
+from .config import EXPCONFIG, getDefaultConfig, getMoreMusConfig, getHintConfig
 
 from sortedcontainers import SortedSet
 
@@ -23,13 +27,55 @@ class ExplainError(Exception):
     pass
 
 
+# Rebuild the output of explain_steps from the lines of a stream, where the
+# first line is the output_header and each other line is one step
+def aggregate_stream(lines):
+    lines = (l for l in lines if l.strip())
+    output = json.loads(next(lines))
+    output["steps"] = [json.loads(l) for l in lines]
+    return output
+
+
+# Killing a lookahead must also kill its pool
+def _lookahead_sigterm(signum, frame):
+    for p in multiprocessing.active_children():
+        p.terminate()
+    os._exit(0)
+
+
+# Runs in a forked process: add 'lits' to the known literals, and send back
+# the MUSes for 'unexplained' (and the finder's cache, and solver stats)
+def _lookahead_main(mus_finder, solver, lits, unexplained, conn):
+    signal.signal(signal.SIGTERM, _lookahead_sigterm)
+    # We may be killed at any time, so don't share locks with the main process
+    resetSharedInts()
+    for p in lits:
+        solver.addLit(p)
+    solver.reset_stats()
+    mus_dict = mus_finder.smallestMUS([solver._litids[p] for p in unexplained])
+    conn.send((mus_dict, mus_finder.cacheState(), solver.get_stats()))
+    conn.close()
+
+
 class Explainer(object):
-    def __init__(self, mus_finder=None, merge=1, skip=0, debug=False, steps_explained=0, hint_setup=False):
+    """
+    pipeline: while a step is rendered, start looking for the next step's
+        MUSes in the background (assumes we are allowed to fork). Call
+        cancel_lookahead when no more steps are needed. This does nothing
+        unless pool workers are forked (poolStartMethod), and without
+        reusePool.
+    """
+
+    def __init__(self, mus_finder=None, merge=1, skip=0, debug=False, steps_explained=0, hint_setup=False, pipeline=False):
         self.steps_explained = steps_explained
         self.mus_finder_name = mus_finder
         self.hint_setup = hint_setup
         self.merge = merge
         self.skip = skip
+        self.pipeline = pipeline
+        # (process, connection, known lits, unexplained lits) for the
+        # running lookahead
+        self._lookahead = None
 
         if debug:
             logging.basicConfig(
@@ -44,6 +90,21 @@ class Explainer(object):
         self.explained = []
         self.config = self.get_config()
 
+    # A running lookahead belongs to this process, so is not saved
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d["_lookahead"] = None
+        return d
+
+    def __setstate__(self, d):
+        # Explainers saved by older versions lack newer options
+        d.setdefault("pipeline", False)
+        d.setdefault("_lookahead", None)
+        self.__dict__ = d
+        # Add new config options in place, as the MUS finder shares the dict
+        for (key, value) in self.get_config().items():
+            self.config.setdefault(key, value)
+
     def get_config(self):
         if self.hint_setup:
             return getHintConfig()
@@ -76,39 +137,52 @@ class Explainer(object):
     """
 
     def explain_steps(self, *, lit_choice=None, mus_choice=None, num_steps=None, allow_update=True):
+        steps = list(
+            self.iter_steps(
+                lit_choice=lit_choice,
+                mus_choice=mus_choice,
+                num_steps=num_steps,
+                allow_update=allow_update,
+            )
+        )
+        return dict(self.output_header(), steps=steps)
+
+    """
+    The same as explain_steps, but a generator which yields each step as
+    soon as it has been explained, rather than returning them all at the end.
+    """
+
+    def iter_steps(self, *, lit_choice=None, mus_choice=None, num_steps=None, allow_update=True):
         if not self.puzzle or not self.solver or not self.solution:
             raise ExplainError("Puzzle has not been correctly initialised.")
 
-        steps = []
         if num_steps is not None:
             for i in range(1, num_steps + 1):
                 if len(self.unexplained) <= 0:
                     break
                 if i == 1:
-                    steps.append(
-                        self.explain_step(
-                            lit_choice=lit_choice, mus_choice=mus_choice, allow_update=allow_update
-                        )
+                    yield self.explain_step(
+                        lit_choice=lit_choice, mus_choice=mus_choice, allow_update=allow_update
                     )
                 else:
-                    steps.append(self.explain_step())
+                    yield self.explain_step()
         else:
             first_step = True
             while len(self.unexplained) > 0:
                 if first_step:
-                    steps.append(
-                        self.explain_step(
-                            lit_choice=lit_choice, mus_choice=mus_choice
-                        )
+                    yield self.explain_step(
+                        lit_choice=lit_choice, mus_choice=mus_choice
                     )
                     first_step = False
                 else:
-                    steps.append(self.explain_step())
+                    yield self.explain_step()
 
         if len(self.unexplained) == 0:
-            steps.append(self.get_solved_step())
+            yield self.get_solved_step()
 
-        return {"name": self.name, "params": self.params, "steps": steps}
+    # Everything in the output of explain_steps, apart from the steps
+    def output_header(self):
+        return {"name": self.name, "params": self.params}
 
     """
     lit_choice: explain what would be needed to work out this literal. form: {'row':-, 'column':-, 'value':-}
@@ -123,11 +197,11 @@ class Explainer(object):
         if lit_choice is not None:
             l = self.find_lit(lit_choice["row"], lit_choice["column"], lit_choice["value"])
             if l is not None:
-                mus_dict = self.mus_finder.smallestMUS([l])
+                mus_dict = self.mus_finder.smallestMUS(self._ids([l]))
             else:
-                mus_dict = self.mus_finder.smallestMUS(self.unexplained)
+                mus_dict = self._smallest_mus(self.unexplained)
         else:
-            mus_dict = self.mus_finder.smallestMUS(self.unexplained)
+            mus_dict = self._smallest_mus(self.unexplained)
 
         mus_dict.remove_duplicates()
 
@@ -144,14 +218,16 @@ class Explainer(object):
                     for p in sorted(skipped)
                 ]
                 if allow_update:
-                    self._add_known(skipped)
+                    self._add_known(self._lits(skipped))
 
-                mus_dict = self.mus_finder.smallestMUS(self.unexplained)
+                mus_dict = self._smallest_mus(self.unexplained)
                 smallest = mus_dict.minimum()
 
             merged = mus_dict.filter_literals_by_mus(
                 lambda mus: len(mus) <= self.merge
             )
+            if allow_update:
+                self._start_lookahead(self._lits(merged))
 
             step_dict["puzzleState"] = self._get_puzzle_state(
                 merged, mus_dict.get_all(merged)
@@ -162,7 +238,7 @@ class Explainer(object):
                 for p in sorted(merged)
             ]
             if allow_update:
-                self._add_known(merged)
+                self._add_known(self._lits(merged))
         else:
             if self.config["findLarger"]:
                 lit_choices = mus_dict.filter_literals_by_mus(
@@ -181,29 +257,103 @@ class Explainer(object):
                 proven_dict,
             ) = self._choose_mus(lit_choices, mus_dict)
 
-            choices, proven_lit_choices = self._choices_list(mus_dict)
+            if allow_update and mus_choice is None:
+                self._start_lookahead(self._lits(best_proven_lits))
+
+            choices, proven_lit_choices = self._choices_list(mus_dict, proven_dict)
 
             if mus_choice is not None:
                 best_proven_lits = proven_lit_choices[mus_choice]
                 best_mus = mus_dict.get(lit_choices[mus_choice])[0]
-            else:
-                (
-                    best_lit,
-                    best_mus,
-                    best_proven_lits,
-                    proven_dict,
-                ) = self._choose_mus(lit_choices, mus_dict)
 
             step_dict = self._get_step_dict(best_proven_lits, best_mus)
             step_dict["otherChoices"] = choices
             if allow_update:
-                self._add_known(best_proven_lits)
+                self._add_known(self._lits(best_proven_lits))
         
         if allow_update:
             self.steps_explained += 1
 
         return step_dict
 
+    # The MUS finders work on the solver's integer ids for literals and
+    # constraints, so the MusDicts they return, and the literals and MUSes
+    # passed around while building a step, are ids. These convert between
+    # lits and their ids.
+    def _ids(self, lits):
+        litids = self.solver._litids
+        return [litids[p] for p in lits]
+
+    def _lits(self, ids):
+        idlits = self.solver._idlits
+        return [idlits[i] for i in ids]
+
+    def _smallest_mus(self, puzlits):
+        mus_dict = self._finish_lookahead(puzlits)
+        if mus_dict is None:
+            mus_dict = self.mus_finder.smallestMUS(self._ids(puzlits))
+        return mus_dict
+
+    # Start finding the MUSes for the next step in a background process,
+    # assuming 'lits' are about to be added to the known literals
+    def _start_lookahead(self, lits):
+        # A reused pool belongs to this process, so can't be shared. The
+        # lookahead is forked, and would share the published solver used by
+        # workers which are not, which this process may replace at any time.
+        if (
+            not self.pipeline
+            or EXPCONFIG["reusePool"]
+            or EXPCONFIG["poolStartMethod"] != "fork"
+        ):
+            return
+        self.cancel_lookahead()
+        litset = set(lits)
+        unexplained = [p for p in self.unexplained if p not in litset]
+        if len(unexplained) == 0:
+            return
+        known = SortedSet(self.solver.getKnownLits()).union(lits)
+        (recv, send) = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.get_context("fork").Process(
+            target=_lookahead_main,
+            args=(self.mus_finder, self.solver, list(lits), unexplained, send),
+        )
+        proc.start()
+        send.close()
+        self._lookahead = (proc, recv, known, unexplained)
+
+    # Return the lookahead's MUSes, if it was looking for 'puzlits' with the
+    # known literals we now have. Otherwise throw it away and return None.
+    def _finish_lookahead(self, puzlits):
+        if self._lookahead is None:
+            return None
+        (proc, recv, known, unexplained) = self._lookahead
+        if list(puzlits) != unexplained or SortedSet(self.solver.getKnownLits()) != known:
+            logging.info("Discarding lookahead")
+            self.cancel_lookahead()
+            return None
+        self._lookahead = None
+        try:
+            (mus_dict, cache, stats) = recv.recv()
+        except EOFError:
+            logging.warning("Lookahead process failed")
+            mus_dict = None
+        else:
+            logging.info("Using lookahead")
+            self.mus_finder.setCacheState(cache)
+            self.solver.add_stats(stats)
+        recv.close()
+        proc.join()
+        return mus_dict
+
+    # Stop any running lookahead
+    def cancel_lookahead(self):
+        if self._lookahead is not None:
+            (proc, recv, _, _) = self._lookahead
+            self._lookahead = None
+            proc.terminate()
+            proc.join()
+            recv.close()
+
     def find_lit(self, row, column, value):
         for l in self.unexplained:
             if str(l.var._location[0]) == str(row) and l.var._location[1] == str(column) and str(l.val) == str(value):
@@ -211,7 +361,7 @@ class Explainer(object):
         return None
 
     def get_choices(self):
-        mus_dict = self.mus_finder.smallestMUS(self.unexplained)
+        mus_dict = self._smallest_mus(self.unexplained)
         smallest = mus_dict.minimum()
 
         if smallest <= self.merge:
@@ -237,7 +387,8 @@ class Explainer(object):
         self.steps_explained += 1
         return step_dict
 
-    def _choices_list(self, mus_dict):
+    # 'proven_dict' is from _choose_mus, if it has already been called
+    def _choices_list(self, mus_dict, proven_dict=None):
         smallest = mus_dict.minimum()
         choices = []
         proven_lit_choices = []
@@ -255,12 +406,13 @@ class Explainer(object):
                     lambda mus: len(mus) == smallest
                 )
 
-            (
-                _,
-                _,
-                _,
-                proven_dict,
-            ) = self._choose_mus(lit_choices, mus_dict)
+            if proven_dict is None:
+                (
+                    _,
+                    _,
+                    _,
+                    proven_dict,
+                ) = self._choose_mus(lit_choices, mus_dict)
 
             for p in lit_choices:
                 for mus in tuple(SortedSet(mus_dict.get(p))):
@@ -289,7 +441,7 @@ class Explainer(object):
     def _get_deduction(self, lits, mus):
         exp = {}
         exp["decision"] = (
-            "Setting " + ", ".join(str(l) for l in lits) + " because:"
+            "Setting " + ", ".join(str(l) for l in self._lits(lits)) + " because:"
         )
         exp["reason"] = []
 
@@ -297,7 +449,7 @@ class Explainer(object):
             exp["reason"].append("The basic design of the problem")
         else:
             for _, clause in enumerate(sorted(mus)):
-                exp["reason"].append(str(self.solver.explain(clause)))
+                exp["reason"].append(str(self.solver.explain(self.solver._idcons[clause])))
 
         return exp
 
@@ -306,22 +458,31 @@ class Explainer(object):
 
         vars = self.solver.puzzle().vars()
         known = self.solver.getKnownLits()
-        involved = [m.clauseset() for m in flatten(mus)]
+        involved = [self.solver._idcons[m].clauseset() for m in flatten(mus)]
+
+        # Map each literal to the (increasing) indices of the involved
+        # clauses it appears in
+        involvedindex = {}
+        for i, clause in enumerate(involved):
+            for lit in flatten(clause):
+                indices = involvedindex.setdefault(lit, [])
+                if len(indices) == 0 or indices[-1] != i:
+                    indices.append(i)
 
         for matrix in vars:
             state.append(
                 self._get_puzzle_matrix(
                     matrix,
                     SortedSet(known),
-                    involved,
-                    SortedSet(flatten(involved)),
-                    SortedSet(lits),
+                    involvedindex,
+                    SortedSet(involvedindex.keys()),
+                    SortedSet(self._lits(lits)),
                 )
             )
 
         return {"matrices": state}
 
-    def _get_puzzle_matrix(self, matrix, known, involved, involvedset, targets):
+    def _get_puzzle_matrix(self, matrix, known, involvedindex, involvedset, targets):
         output_matrix = []
         matrixRow = 0
 
@@ -330,14 +491,14 @@ class Explainer(object):
             for cell in row:
                 output_matrix[matrixRow]["cells"].append(
                     self._get_cell_values(
-                        cell, known, involved, involvedset, targets
+                        cell, known, involvedindex, involvedset, targets
                     )
                 )
             matrixRow += 1
 
         return {"rows": output_matrix}
 
-    def _get_cell_values(self, variable, known, involved, involvedset, targets):
+    def _get_cell_values(self, variable, known, involvedindex, involvedset, targets):
         cell = []
         dom = variable.dom()
 
@@ -360,7 +521,6 @@ class Explainer(object):
                 value = {}
                 markers = []
                 status = ""
-                explanations = []
                 poslit = EqVal(variable, d)
                 neglit = NeqVal(variable, d)
                 if neglit in targets:
@@ -382,12 +542,10 @@ class Explainer(object):
                 if poslit in known:
                     markers.append("pik")
 
-                for i, clause in enumerate(involved):
-
-                    if in_flattened(clause, poslit) or in_flattened(clause, neglit):
-                        explanations.append(str(i))
-                        # We want this to be "the" explanation that makes d
-                        # postlit or neglit in targets
+                # We want this to be "the" explanation that makes d
+                # postlit or neglit in targets
+                indices = involvedindex.get(poslit, []) + involvedindex.get(neglit, [])
+                explanations = [str(i) for i in sorted(set(indices))]
 
                 value["markers"] = markers
                 value["value"] = d
@@ -404,10 +562,11 @@ class Explainer(object):
 
     def _get_puzzle_solution(self, no_domains=None, allow_incomplete=False):
 
-        logging.debug(self.solver.solve(getsol=True))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(self.solver.solve(getsol=True))
 
         if allow_incomplete:
-            solution = self.solver.solveAll([])
+            solution = self.solver.solveAll([], cores=self.config["cores"])
         else:
             solution = self.solver.solveSingle([])
 
@@ -433,42 +592,51 @@ class Explainer(object):
         best_mus_stat = (math.inf, math.inf, math.inf)
         proven_dict = {}
 
-        checked = set([])
-
+        # We only check which literals a MUS proves if it could be the best
+        # so far, that is if its (size, unexplained) is no bigger than the
+        # smallest so far. This doesn't depend on the results of the checks,
+        # so we can find all the checks first and do them together.
+        entries = []
+        checks = []
+        best_pair = (math.inf, math.inf)
+        unexplained = self._ids(self.unexplained)
         for b in candidates:
             proven_dict[b] = {}
             for mus in mus_dict.get(b):
 
-                mus_lits = SortedSet.union(
-                    SortedSet(), *(SortedSet(m.lits()) for m in mus)
-                )
+                # Lits (and negations) in the MUS, by id
+                mus_lits = self.solver.litIdsOfConstraints(mus)
 
                 unexplained_in_mus = SortedSet(
-                    p
-                    for p in self.unexplained
-                    if p in mus_lits or p.neg() in mus_lits
+                    p for p in unexplained if p in mus_lits
                 )
 
-                # Explictly add 'b', for the case where the MUS is size 0 in
-                # particular
-                if (len(mus), len(unexplained_in_mus)) < best_mus_stat:
-                    proven_lits = SortedSet(
-                        checkWhichLitsAMUSProves(
-                            self.solver, unexplained_in_mus, mus, self.config
-                        )
-                    ).union(SortedSet([b]))
-                else:
-                    proven_lits = SortedSet([b])
+                pair = (len(mus), len(unexplained_in_mus))
+                check = pair <= best_pair
+                best_pair = min(best_pair, pair)
+                if check:
+                    checks.append((unexplained_in_mus, mus))
+                entries.append((b, mus, unexplained_in_mus, check))
+
+        results = iter(checkWhichLitsMUSesProve(self.solver, checks, self.config))
+
+        for (b, mus, unexplained_in_mus, check) in entries:
+            # Explictly add 'b', for the case where the MUS is size 0 in
+            # particular
+            if check:
+                proven_lits = SortedSet(next(results)).union(SortedSet([b]))
+            else:
+                proven_lits = SortedSet([b])
 
-                proven_dict[b][mus] = proven_lits
+            proven_dict[b][mus] = proven_lits
 
-                musval = (len(mus), len(unexplained_in_mus), -len(proven_lits))
+            musval = (len(mus), len(unexplained_in_mus), -len(proven_lits))
 
-                if musval < best_mus_stat:
-                    best_mus_stat = musval
-                    best_lit = b
-                    best_mus = mus
-                    best_proven_lits = proven_lits
+            if musval < best_mus_stat:
+                best_mus_stat = musval
+                best_lit = b
+                best_mus = mus
+                best_proven_lits = proven_lits
 
         return best_lit, best_mus, best_proven_lits, proven_dict
 
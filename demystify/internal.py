@@ -4,13 +4,16 @@ import copy
 import types
 import random
 import logging
+import numpy
 from sortedcontainers import *
+from pysat.formula import CNF
 
 from .utils import flatten, chainlist, randomFromSeed
 
 from .base import EqVal, NeqVal
 
 from .config import EXPCONFIG
+from .parallel import getPool, setChildSolver, getChildSolver, unpublish
 
 # A variable is a dictionary mapping values to their SAT variable
 
@@ -18,6 +21,22 @@ from .solvers.z3impl import Z3Solver
 from .solvers.pysatimpl import SATSolver
 
 
+# Pack a list of lists of integers into arrays (offsets, values)
+def _csr(rows):
+    offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(r) for r in rows])
+    if len(rows) > 0 and offsets[-1] > 0:
+        values = numpy.concatenate([numpy.asarray(r, dtype=numpy.int64) for r in rows])
+    else:
+        values = numpy.zeros(0, dtype=numpy.int64)
+    return (offsets, values)
+
+
+def _parfunc_backbone(args):
+    (candidates, lits) = args
+    return getChildSolver()._solver.backbone(candidates, lits)
+
+
 class Solver:
     def __init__(self, puzzle, *, cnf=None, litmap=None, conmap=None):
         assert puzzle is not None
@@ -57,6 +76,8 @@ class Solver:
         # Used for tracking in push/pop/addLits
         self._stackknownlits = []
         self._knownlits = []
+        # The same as _knownlits, for fast membership tests
+        self._knownlitset = set()
 
         # For benchmarking
         self._corecount = 0
@@ -135,34 +156,144 @@ class Solver:
             self._conlit2conmap[con] = var
             self._conlits.add(var)
 
+    # The CNF shares its clause list with the SATSolver, which pickles it
+    # compactly, so we only store the variable count and rebuild the CNF
+    # when it is next used
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        if isinstance(d.get("_cnf"), CNF):
+            d["_cnfnv"] = d.pop("_cnf").nv
+        return d
+
+    # Pickles from older versions have none of the literal / constraint maps
+    # made by init_litmappings (they had their own, which are dropped), so
+    # build them again
+    def __setstate__(self, d):
+        self.__dict__ = d
+        if "_knownlitset" not in d:
+            self._knownlitset = set(self._knownlits)
+        if "_litids" not in d:
+            for name in ("_varlit2con", "_varlit2negconnectedlits", "_varlit2con2"):
+                d.pop(name, None)
+            self.init_litmappings()
+
+    def __getattr__(self, name):
+        if name == "_cnf" and "_cnfnv" in self.__dict__:
+            cnf = CNF()
+            cnf.clauses = self._solver._clauses
+            cnf.nv = self.__dict__.pop("_cnfnv")
+            self._cnf = cnf
+            return cnf
+        raise AttributeError(name)
+
     def init_litmappings(self):
-        # Set up some mappings for efficient finding of tiny MUSes
-        # Map from a var lit to all the constraints it is in
-        self._varlit2con = {l: SortedSet() for l in self._varlit2smtmap.keys()}
-
-        # Map from a var lit to the negation of all lits it is in a constraint with
-        # (to later make distance 2 mappings)
-        self._varlit2negconnectedlits = {
-            l: SortedSet() for l in self._varlit2smtmap.keys()
-        }
-
-        for (cvar, con) in self._conmap.items():
-            lits = con.lits()
-            # Negate all the lits
-            neglits = [l.neg() for l in lits]
-            for l in neglits:
-                self._varlit2con[l].add(cvar)
-                self._varlit2negconnectedlits[l].update(neglits)
-
-        # Map from a var lit to all constraints it is distance 2 from
-        self._varlit2con2 = (
-            {}
-        )  # {l : SortedSet() for l in self._varlit2smtmap.keys() }
-        for (lit, connected) in self._varlit2negconnectedlits.items():
-            allcon = SortedSet.union(
-                *[self._varlit2con[x] for x in connected], SortedSet()
-            ).union(self._varlit2con[lit])
-            self._varlit2con2[lit] = allcon
+        # Set up some mappings for efficient finding of tiny MUSes.
+        # These are stored as 'compressed sparse rows': a pair of arrays
+        # (offsets, values), where row i is values[offsets[i]:offsets[i+1]].
+
+        # Give each var lit and each constraint a dense integer id. The MUS
+        # code and MusDicts work on these ids, which only become Lit and
+        # constraint objects again when the explainer writes its output.
+        # Ids are given in sorted order, so sorting ids gives the same order
+        # as sorting the objects they stand for.
+        self._idlits = sorted(self._varlit2smtmap.keys())
+        self._litids = {l: i for (i, l) in enumerate(self._idlits)}
+        # The SAT literal of each lit id
+        self._idsmt = [self._varlit2smtmap[l] for l in self._idlits]
+        self._negids = numpy.array(
+            [self._litids[l.neg()] for l in self._idlits], dtype=numpy.int64
+        )
+        self._idcons = sorted(self._conlit2conmap.keys())
+        self._conids = {c: i for (i, c) in enumerate(self._idcons)}
+        # The selector of each constraint id, and the reverse
+        self._conidsels = [self._conlit2conmap[c] for c in self._idcons]
+        self._selconids = {sel: i for (i, sel) in enumerate(self._conidsels)}
+
+        # Each constraint selector also has a position, for the tables below
+        conlist = list(self._conlits)
+        self._conpos = {c: i for (i, c) in enumerate(conlist)}
+        if all(isinstance(c, int) for c in conlist):
+            self._conarray = numpy.array(conlist, dtype=numpy.int64)
+        else:
+            self._conarray = numpy.empty(len(conlist), dtype=object)
+            self._conarray[:] = conlist
+
+        # Map from a constraint position to the ids of the negations of its lits
+        conrows = []
+        # Map from a var lit id to the positions of the constraints its
+        # negation is in (in increasing order)
+        litrows = [[] for _ in self._litids]
+        for (pos, cvar) in enumerate(conlist):
+            negids = [self._litids[l.neg()] for l in self._conmap[cvar].lits()]
+            conrows.append(negids)
+            for i in negids:
+                litrows[i].append(pos)
+
+        self._con2lits = _csr(conrows)
+        self._lit2cons = _csr(litrows)
+        # The same, but giving the constraint selectors, so lookups are slices
+        self._lit2conlits = (self._lit2cons[0], self._conarray[self._lit2cons[1]])
+
+        # Map from a var lit to all constraints it is distance 2 from,
+        # built by buildDistance2 when first needed
+        self._lit2conlits2 = None
+
+        # Build clause occurrence lists now, for model rotation in MUS, so
+        # every worker process doesn't have to build its own copy
+        if EXPCONFIG["useModelRotation"] and isinstance(self._solver, SATSolver):
+            self._solver.occurrences()
+
+    # The id of the negation of the lit with id 'i'
+    def negLitId(self, i):
+        return int(self._negids[i])
+
+    # The constraints which contain the negation of the lit with id 'i', as
+    # an array of constraint selectors
+    def varlit2con(self, i):
+        (offsets, values) = self._lit2conlits
+        return values[offsets[i]: offsets[i + 1]]
+
+    # The ids of the lits in the constraints with ids 'cons', and their negations
+    def litIdsOfConstraints(self, cons):
+        (offsets, values) = self._con2lits
+        rows = []
+        for c in cons:
+            pos = self._conpos[self._conidsels[c]]
+            rows.append(values[offsets[pos]: offsets[pos + 1]])
+        if len(rows) == 0:
+            return set()
+        ids = numpy.concatenate(rows)
+        return set(ids.tolist()).union(self._negids[ids].tolist())
+
+    # The constraints which share a literal with any constraint in
+    # varlit2con(i), or are in it
+    def varlit2con2(self, i):
+        self.buildDistance2()
+        (offsets, values) = self._lit2conlits2
+        return values[offsets[i]: offsets[i + 1]]
+
+    # Call before forking, so child processes share the distance 2 map
+    def buildDistance2(self):
+        if self._lit2conlits2 is not None:
+            return
+        (conoffsets, conlits) = self._con2lits
+        (litoffsets, litcons) = self._lit2cons
+        rows = []
+        for i in range(len(self._litids)):
+            cons = litcons[litoffsets[i]: litoffsets[i + 1]]
+            near = [conlits[conoffsets[c]: conoffsets[c + 1]] for c in cons]
+            near = numpy.unique(numpy.concatenate(near + [numpy.array([i], dtype=numpy.int64)]))
+            rows.append(
+                numpy.unique(
+                    numpy.concatenate(
+                        [litcons[litoffsets[j]: litoffsets[j + 1]] for j in near]
+                    )
+                )
+            )
+        (offsets, values) = _csr(rows)
+        self._lit2conlits2 = (offsets, self._conarray[values])
+        # Workers which load a published copy should get the map too
+        unpublish(self)
 
     def puzzle(self):
         return self._puzzle
@@ -243,18 +374,45 @@ class Solver:
             print(SortedSet(sol2) - SortedSet(sol1))
             return self.Multiple
 
-    # This is the same as 'solve', but checks if there are many solutions,
-    # returning Solver.Multiple if there is more than one solution
-    def solveAll(self, assume=tuple()):
+    # Return the literals which are true in every solution (the backbone),
+    # or None if there are no solutions. With more than one core, the
+    # candidates from the first solution are split between a pool. Each
+    # worker only filters its own group: a model one worker finds may refute
+    # candidates in another group, but that worker has to find its own.
+    def solveAll(self, assume=tuple(), *, cores=1):
         smtassume = [self._varlit2smtmap[l] for l in assume]
-        sol = self._solveAll(smtassume)
+        if cores <= 1:
+            sol = self._solveAll(smtassume)
+        else:
+            sol = self._solveAllParallel(smtassume, cores)
+        if sol is None:
+            return None
         return self.var_smt2lits(sol)
 
+    def _solveAllParallel(self, smtassume, cores):
+        lits = chainlist(self._conlits, smtassume)
+        sol = self._solver.solve(lits, getsol=True)
+        if sol is None:
+            return None
+        candidates = [p if sol[p] else -p for p in self._varsmt]
+        if len(candidates) == 0:
+            return {}
+        # Neighbouring variables tend to be refuted by the same solutions,
+        # so split into contiguous groups
+        groups = cores * EXPCONFIG["poolBatchFactor"]
+        size = -(-len(candidates) // groups)
+        args = [(candidates[i : i + size], lits) for i in range(0, len(candidates), size)]
+        setChildSolver(self)
+        with getPool(cores) as pool:
+            res = pool.map(_parfunc_backbone, args)
+        return {abs(l): l > 0 for backbone in res for l in backbone}
+
     # Return a subset of 'lits' which forms a core, or
-    # None if no core exists (or can be proved in the time limit)
-    def basicCore(self, lits):
+    # None if no core exists (or can be proved in the time limit).
+    # 'escalate' uses the largest time limit.
+    def basicCore(self, lits, *, escalate=False):
         self._corecount += 1
-        solve = self._solver.solveLimited(lits)
+        solve = self._solver.solveLimited(lits, escalate=escalate)
         if solve is True or solve is None:
             return None
         if EXPCONFIG["useUnsatCores"]:
@@ -264,14 +422,58 @@ class Solver:
             core = lits
         return core
 
+    # The same as basicCore, but returns a pair (core, model), where
+    # model is the SAT model if 'lits' is satisfiable (and None otherwise)
+    def basicCoreWithModel(self, lits, *, escalate=False):
+        self._corecount += 1
+        solve = self._solver.solveLimited(lits, escalate=escalate)
+        if solve is None:
+            return (None, None)
+        if solve is True:
+            return (None, self._solver.model())
+        if EXPCONFIG["useUnsatCores"]:
+            core = self._solver.unsat_core()
+            assert SortedSet(core).issubset(SortedSet(lits))
+        else:
+            core = lits
+        return (core, None)
+
+    # Unit propagate internal literals 'lits', and the known literals.
+    # Returns None if the solver does not support propagation, False if
+    # propagation finds a conflict, and otherwise the set of implied literals.
+    def propagate(self, lits):
+        if not isinstance(self._solver, SATSolver):
+            return None
+        (ok, implied) = self._solver.propagate(lits)
+        if not ok:
+            return False
+        return set(implied)
+
     def addLit(self, lit):
-        if lit not in self._knownlits:
+        if lit not in self._knownlitset:
             self._solver.addLit(self._varlit2smtmap[lit])
             self._knownlits.append(lit)
+            self._knownlitset.add(lit)
 
     def getKnownLits(self):
         return self._knownlits
 
+    # The ids of the known literals, to send to pool workers
+    def knownLitIds(self):
+        return [self._litids[l] for l in self._knownlits]
+
+    # Make the known literals those with ids 'ids', so a pool worker's copy
+    # of the solver catches up with the main process
+    def setKnownLitIds(self, ids):
+        lits = [self._idlits[i] for i in ids]
+        if not self._knownlitset.issubset(lits):
+            # Literals can't be removed from the SAT solver, so start again
+            self._knownlits = []
+            self._knownlitset = set()
+            self._solver.clearKnownLits()
+        for l in lits:
+            self.addLit(l)
+
     def getCurrentDomain(self):
         return self._puzzle.modelToAssignment(self.getKnownLits(), partial=True)
 
@@ -283,6 +485,7 @@ class Solver:
     def pop(self):
         self._solver.pop()
         self._knownlits = self._stackknownlits.pop()
+        self._knownlitset = set(self._knownlits)
 
     def explain(self, c):
         return c.explain(self._knownlits)
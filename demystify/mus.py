@@ -1,27 +1,40 @@
 import copy
+import itertools
 import math
 import logging
 import sys
 import math
 import multiprocessing
+import numpy
 
 from sortedcontainers import *
 
 from .utils import flatten, randomFromSeed, safepow
 from .config import EXPCONFIG
-from .parallel import getPool, setChildSolver, getChildSolver
+from .parallel import getPool, setChildSolver, getChildSolver, getSharedInt
 from .musdict import MusDict
+from .muscache import MUSCache
 
 
 # This calculates Minimum Unsatisfiable Sets
 # It uses internals from solver, but is put in another file just for "neatness"
+# Literals and constraints are passed around as the integer ids given to them
+# by the solver (see Solver.init_litmappings), and MUSes are tuples of
+# constraint ids.
+
+
+# The ids of the constraints in 'core', a list of SAT literals which may also
+# contain assumptions
+def _conids(solver, core):
+    return [solver._selconids[x] for x in core if x in solver._selconids]
+
 
 def tinyMUS(solver, assume, distance, badlimit, config):
-    smtassume = [solver._varlit2smtmap[l] for l in assume]
+    smtassume = [solver._idsmt[l] for l in assume]
     if distance == 1:
-        cons = flatten([solver._varlit2con[l] for l in assume])
+        cons = numpy.concatenate([solver.varlit2con(l) for l in assume]).tolist()
     elif distance == 2:
-        cons = flatten([solver._varlit2con2[l] for l in assume])
+        cons = numpy.concatenate([solver.varlit2con2(l) for l in assume]).tolist()
     else:
         cons = list(solver._conlits)
 
@@ -45,16 +58,154 @@ def tinyMUS(solver, assume, distance, badlimit, config):
                     return None
 
     logging.debug("ZZPass %s %s %s", lit, len(core), badcount)
-    return [solver._conmap[x] for x in core if x in solver._conmap]
+    return _conids(solver, core)
 
 
 count = 0
 
 
+# 'cancel' is an optional function, polled between SAT calls. When it returns
+# True the search is abandoned (another worker has already found what we need)
+def _cancelled(cancel):
+    return cancel is not None and cancel()
+
+
+# Recursive model rotation. 'model' satisfies every constraint in 'core'
+# except 'con', so 'con' must be in every MUS inside 'core'. If flipping one
+# variable gives an assignment which only breaks one other constraint in
+# 'core', that constraint must be in every MUS too, and we can repeat from
+# the new assignment. Returns the set of new constraints found this way
+# (we do not rotate again from constraints already in 'known').
+def modelRotation(solver, model, con, core, smtassume, known=()):
+    satsolver = solver._solver
+    clauses = satsolver._clauses
+    occurs = satsolver.occurrences()
+    # 'core' can also contain the assumptions
+    coreset = set(c for c in core if c in solver._conlits)
+    # Variables we are not allowed to flip
+    assumed = set(abs(x) for x in smtassume)
+    knownlits = satsolver._knownlits
+
+    def fixed(var):
+        return var in assumed or var in knownlits or -var in knownlits
+
+    # Assignments are 'model' with the variables in 'flipped' flipped, and
+    # all constraints in core turned on, except 'off'
+    def value(lit, flipped, off):
+        var = abs(lit)
+        if var in coreset:
+            val = var != off
+        else:
+            val = (model[var - 1] > 0) != (var in flipped)
+        return val == (lit > 0)
+
+    # This is the inner loop, so 'value' is inlined here
+    def satisfied(i, flipped, off):
+        for lit in clauses[i]:
+            var = lit if lit > 0 else -lit
+            if var in coreset:
+                val = var != off
+            else:
+                val = (model[var - 1] > 0) != (var in flipped)
+            if val == (lit > 0):
+                return True
+        return False
+
+    seen = set(known)
+    seen.add(con)
+    found = set()
+    todo = [(frozenset(), con)]
+    while len(todo) > 0:
+        (flipped, off) = todo.pop()
+        # The clauses which break when we turn 'off' back on
+        broken = [i for i in occurs.get(-off, ()) if not satisfied(i, flipped, None)]
+        if len(broken) == 0:
+            continue
+        # A single flip has to fix all the broken clauses
+        flips = set(abs(l) for l in clauses[broken[0]])
+        for i in broken[1:]:
+            flips.intersection_update(abs(l) for l in clauses[i])
+        for var in sorted(flips):
+            if fixed(var) or var in solver._conlits:
+                continue
+            newflipped = flipped ^ {var}
+            if not all(satisfied(i, newflipped, None) for i in broken):
+                continue
+            # Only clauses containing the literal we just made false can break
+            nowfalse = var if value(var, flipped, None) else -var
+            newbroken = [
+                i for i in occurs.get(nowfalse, ()) if not satisfied(i, newflipped, None)
+            ]
+            if len(newbroken) == 0:
+                continue
+            for l in clauses[newbroken[0]]:
+                nextoff = -l
+                if nextoff in coreset and nextoff not in seen and all(
+                        l in clauses[i] for i in newbroken
+                ) and all(
+                    satisfied(i, newflipped, nextoff) for i in occurs.get(nextoff, ())
+                ):
+                    seen.add(nextoff)
+                    found.add(nextoff)
+                    todo.append((newflipped, nextoff))
+                    break
+
+    return found
+
+
+# QuickXplain (divide and conquer) shrinking: split the constraints in half,
+# find which constraints of the second half are needed with all of the first
+# half, then which of the first half are needed with those. This needs
+# O(k log(n/k)) SAT calls for a MUS of size k, rather than one call per
+# constraint. Returns the MUS (as a list of constraint literals), or None
+# if the MUS would be bigger than maxsize, or the search was cancelled.
+def quickXplain(solver, smtassume, cons, maxsize, *, cancel=None):
+    stats = {"calls": 0, "found": 0}
+
+    # Return a minimal subset of 'cons' which is unsat together with
+    # 'background', given that 'background + cons' is unsat.
+    # 'changed' is False if we already know 'background' is satisfiable.
+    def qx(background, changed, cons):
+        if changed:
+            if _cancelled(cancel):
+                return None
+            stats["calls"] += 1
+            if solver.basicCore(smtassume + background) is not None:
+                return []
+        if len(cons) == 1:
+            # Everything we return is in the final MUS, so we can give up
+            # as soon as we have found too many constraints
+            stats["found"] += 1
+            if stats["found"] > maxsize:
+                return None
+            return list(cons)
+        half = len(cons) // 2
+        first, second = cons[:half], cons[half:]
+        need2 = qx(background + first, True, second)
+        if need2 is None:
+            return None
+        need1 = qx(background + need2, len(need2) > 0, first)
+        if need1 is None:
+            return None
+        return need1 + need2
+
+    if len(cons) == 0:
+        return []
+    mus = qx([], False, list(cons))
+    logging.debug(
+        "QuickXplain: %s to %s, with %s steps (maxsize %s)",
+        len(cons),
+        None if mus is None else len(mus),
+        stats["calls"],
+        maxsize,
+    )
+    return mus
+
+
 def MUS(
-        r, solver, assume, minsize, *, config, initial_cons=None, just_check=False
+        r, solver, assume, minsize, *, config, initial_cons=None, just_check=False, cancel=None
 ):
-    smtassume = [solver._varlit2smtmap[a] for a in assume]
+    smtassume = [solver._idsmt[a] for a in assume]
 
     if EXPCONFIG["dumpSAT"]:
         global count
@@ -68,7 +219,7 @@ def MUS(
     if initial_cons is None:
         if config["checkCloseFirst"]:
             closecons = SortedSet(
-                flatten([solver._varlit2con[l] for l in assume])
+                numpy.concatenate([solver.varlit2con(l) for l in assume]).tolist()
             )
             farcons = solver._conlits - closecons
             cons = r.sample(closecons, len(closecons)) + r.sample(
@@ -79,7 +230,7 @@ def MUS(
             r.shuffle(cons)
 
     else:
-        cons = [solver._conlit2conmap[x] for x in initial_cons]
+        cons = [solver._conidsels[x] for x in initial_cons]
         r.shuffle(cons)
 
     # Need to use 'sample' as solver._conlits is a SortedSet
@@ -98,6 +249,8 @@ def MUS(
     if config["prechopMUSes12"]:
         step = int(len(core) * (0.8))
         while step > 1 and len(core) > minsize:
+            if _cancelled(cancel):
+                return None
             to_test = core[:-step]
             newcore = solver.basicCore(smtassume + to_test)
             if newcore is not None:
@@ -139,6 +292,8 @@ def MUS(
         if loopsize <= 10:
             done = False
             for tries in range(loopsize):
+                if _cancelled(cancel):
+                    return None
                 r.shuffle(core)
                 newcore = solver.basicCore(smtassume + core[:-step])
                 if newcore is not None:
@@ -163,6 +318,8 @@ def MUS(
             i = 0
             badcount = 0
             while i * step < len(core):
+                if _cancelled(cancel):
+                    return None
                 to_test = core[: (i * step)] + core[((i + 1) * step):]
                 solvable = solver._solver.solveLimited(smtassume + to_test)
                 logging.debug(
@@ -197,6 +354,8 @@ def MUS(
             i = 0
             badcount = 0
             while i * step < len(core):
+                if _cancelled(cancel):
+                    return None
                 to_test = core[: (i * step)] + core[((i + 1) * step):]
                 solvable = solver._solver.solveLimited(smtassume + to_test)
                 logging.debug(
@@ -247,14 +406,14 @@ def MUS(
             # Stage 1: Look for something to delete
             solvable = False
             while not solvable:
+                if _cancelled(cancel):
+                    return None
                 logging.debug("Core step up: %s %s %s", pos, len(core), step)
                 if pos >= len(core):
                     logging.debug(
                         "Core passed: %s %s %s", assume, len(core), calls
                     )
-                    return [
-                        solver._conmap[x] for x in core if x in solver._conmap
-                    ]
+                    return _conids(solver, core)
 
                 to_test = core[:pos] + core[(pos + step):]
                 assert len(to_test) < len(core)
@@ -270,6 +429,8 @@ def MUS(
             step = step // 2
             # Stage 2: Focus
             while step > 0:
+                if _cancelled(cancel):
+                    return None
                 logging.debug(
                     "Core Stage 2 step: %s %s %s", pos, len(core), step
                 )
@@ -303,11 +464,15 @@ def MUS(
                     logging.debug(
                         "Core found: %s %s %s", assume, minsize, calls
                     )
-                    return [
-                        solver._conmap[x]
-                        for x in to_test
-                        if x in solver._conmap
-                    ]
+                    return _conids(solver, to_test)
+
+    if config["quickXplainMUSes"]:
+        core = quickXplain(solver, smtassume, core, minsize, cancel=cancel)
+        if core is None:
+            logging.debug("QuickXplain failed: %s %s", assume, minsize)
+            return None
+        logging.info("Core for %s : %s to %s by QuickXplain", assume, lens, len(core))
+        return _conids(solver, core)
 
     # Final cleanup
     # We need to be prepared for things to disappear as we reduce the core, so 
@@ -315,13 +480,30 @@ def MUS(
     stepcount = 0
     badcount = 0
     corecpy = list(core)
+    # Constraints which model rotation has shown must be in the MUS
+    critical = set()
+    # Constraints we could not remove because the solver ran out of budget
+    retry = []
     for lit in corecpy:
+        if _cancelled(cancel):
+            return None
         if lit in core:
-            logging.debug("Trying to remove %s", lit)
-            to_test = list(core)
-            to_test.remove(lit)
-            newcore = solver.basicCore(smtassume + to_test)
-            stepcount += 1
+            if lit in critical:
+                logging.debug("Rotation shows we need: %s", lit)
+                newcore = None
+            else:
+                logging.debug("Trying to remove %s", lit)
+                to_test = list(core)
+                to_test.remove(lit)
+                (newcore, model) = solver.basicCoreWithModel(smtassume + to_test)
+                if model is not None:
+                    if EXPCONFIG["useModelRotation"]:
+                        critical.update(
+                            modelRotation(solver, model, lit, core, smtassume, critical)
+                        )
+                elif newcore is None:
+                    retry.append(lit)
+                stepcount += 1
             if newcore is not None:
                 logging.debug("Can remove: %s", lit)
                 core = newcore
@@ -354,32 +536,54 @@ def MUS(
                             stepcount,
                             len(cutcore)
                         )
-                        return [
-                            solver._conmap[x]
-                            for x in cutcore
-                            if x in solver._conmap
-                        ]
+                        return _conids(solver, cutcore)
+
+    # Try the constraints which ran out of budget again. The core may have
+    # shrunk since, so first try the normal budget, and only escalate when the
+    # solver still cannot tell whether the constraint can be removed. Skip any
+    # which model rotation has since shown are needed.
+    for lit in retry:
+        if _cancelled(cancel):
+            return None
+        if lit in core and lit not in critical:
+            to_test = list(core)
+            to_test.remove(lit)
+            (newcore, model) = solver.basicCoreWithModel(smtassume + to_test)
+            if newcore is None and model is None:
+                newcore = solver.basicCore(smtassume + to_test, escalate=True)
+            elif model is not None and EXPCONFIG["useModelRotation"]:
+                critical.update(
+                    modelRotation(solver, model, lit, core, smtassume, critical)
+                )
+            if newcore is not None:
+                logging.debug("Can remove after retry: %s", lit)
+                core = newcore
+                lens.append((lit, len(core)))
 
     logging.info(
-        "Core for %s : %s to %s, with %s steps, %s bad (minsize %s)",
+        "Core for %s : %s to %s, with %s steps, %s bad, %s by rotation (minsize %s)",
         assume,
         lens,
         len(core),
         stepcount,
         badcount,
+        len(critical),
         minsize,
 
     )
-    return [solver._conmap[x] for x in core if x in solver._conmap]
+    return _conids(solver, core)
 
 
 def _parfunc_dotinymus(args):
     (p, distance, badlimit, config) = args
-    return (p, tinyMUS(getChildSolver(), [p.neg()], distance, badlimit, config))
+    solver = getChildSolver()
+    return (p, tinyMUS(solver, [solver.negLitId(p)], distance, badlimit, config))
 
 
 def getTinyMUSes(solver, puzlits, musdict, *, distance, repeats, badlimit, config):
     setChildSolver(solver)
+    if distance == 2:
+        solver.buildDistance2()
     logging.info(
         "Getting tiny MUSes, distance %s, for %s puzlits, %s repeats",
         distance,
@@ -397,12 +601,13 @@ def getTinyMUSes(solver, puzlits, musdict, *, distance, repeats, badlimit, confi
 
 def _parfunc_docheckmus(args):
     (p, oldmus, config) = args
+    solver = getChildSolver()
     return (
         p,
         MUS(
             randomFromSeed("X"),
-            getChildSolver(),
-            [p.neg()],
+            solver,
+            [solver.negLitId(p)],
             math.inf,
             initial_cons=oldmus,
             config=config,
@@ -425,14 +630,81 @@ def checkMUS(solver, puzlits, oldmus, musdict, config):
                     musdict.update(p, newmus)
 
 
+# Re-minimise 'oldmus', a MUS for 'assume' found before some of the current
+# known literals were known. Adding known literals can never make an unsatisfiable
+# set satisfiable, so 'oldmus' is still a core. Constraints which are now
+# satisfied by a known literal are dropped for free. Then one SAT call on the
+# rest gives an unsat core, which leaves out the constraints the new literals
+# have made redundant. Only if something was removed are the remaining
+# constraints tested for removal one at a time, otherwise the MUS is kept.
+def reminimiseMUS(solver, assume, oldmus):
+    known = set(solver.getKnownLits())
+    smtassume = [solver._idsmt[a] for a in assume]
+    cons = [
+        c
+        for c in oldmus
+        if not all(
+            any(l in known for l in clause)
+            for clause in solver._idcons[c].clauseset()
+        )
+    ]
+    core = [solver._conidsels[c] for c in cons]
+    tests = 1
+    newcore = solver.basicCore(smtassume + core)
+    if newcore is not None:
+        newcore = [x for x in newcore if x in solver._selconids]
+        if len(newcore) < len(core):
+            core = newcore
+    if len(core) < len(oldmus):
+        for lit in list(core):
+            if lit in core:
+                tests += 1
+                to_test = list(core)
+                to_test.remove(lit)
+                newcore = solver.basicCore(smtassume + to_test)
+                if newcore is not None:
+                    core = newcore
+    logging.debug(
+        "Reminimise for %s : %s to %s, with %s tests",
+        assume,
+        len(oldmus),
+        len(core),
+        tests,
+    )
+    return _conids(solver, core)
+
+
+def _parfunc_doreminimisemus(args):
+    (p, oldmus) = args
+    solver = getChildSolver()
+    return (p, reminimiseMUS(solver, [solver.negLitId(p)], oldmus))
+
+
+# Bring an existing dictionary up to date, when known literals have been added
+# since it was made (and none removed), by re-minimising every MUS.
+def recheckMUS(solver, puzlits, oldmus, musdict, config):
+    setChildSolver(solver)
+    jobs = [(p, mus) for p in puzlits if oldmus.contains(p) for mus in oldmus.get(p)]
+
+    logging.info("Rechecking %s cached MUSes", len(jobs))
+    if len(jobs) > 0:
+        # Each job is only a few SAT calls, so only use the pool for big batches
+        cores = config["cores"] if len(jobs) > config["cores"] else 1
+        with getPool(cores) as pool:
+            res = pool.map(_parfunc_doreminimisemus, jobs)
+            for (p, newmus) in res:
+                musdict.update(p, newmus)
+
+
 def _parfunc_dochecklitsmus(args):
     (p, oldmus, config) = args
+    solver = getChildSolver()
     return (
         p,
         MUS(
             randomFromSeed("X"),
-            getChildSolver(),
-            [p.neg()],
+            solver,
+            [solver.negLitId(p)],
             math.inf,
             initial_cons=oldmus,
             just_check=True,
@@ -443,39 +715,102 @@ def _parfunc_dochecklitsmus(args):
 
 # Check which literals are filtered by a particular MUS
 def checkWhichLitsAMUSProves(solver, puzlits, mus, config):
+    return checkWhichLitsMUSesProve(solver, [(puzlits, mus)], config)[0]
+
+
+# Settle which of 'puzlits' 'mus' proves without a SAT call per literal.
+# Literals set by unit propagation from the MUS (and the known literals) are
+# proven. Literals false in some model of the MUS are not, and we look for a
+# model where they are all false first. Returns the pair (proven, unsettled).
+def propagateWhichLitsMUSProves(solver, puzlits, mus):
+    cons = [solver._conidsels[c] for c in mus]
+    implied = solver.propagate(cons)
+    if implied is None:
+        return ([], list(puzlits))
+    if implied is False:
+        # The MUS contradicts the known literals, so proves anything
+        return (list(puzlits), [])
+    smtmap = solver._idsmt
+    proven = [p for p in puzlits if smtmap[p] in implied]
+    unsettled = [
+        p
+        for p in puzlits
+        if smtmap[p] not in implied and -smtmap[p] not in implied
+    ]
+    if len(unsettled) > 0:
+        model = solver._solver.solve(cons + [-smtmap[p] for p in unsettled], getsol=True)
+        if model is None:
+            model = solver._solver.solve(cons, getsol=True)
+        if model is not None:
+            unsettled = [p for p in unsettled if model[abs(smtmap[p])] == (smtmap[p] > 0)]
+    return (proven, unsettled)
+
+
+# The same as checkWhichLitsAMUSProves, for a list of (puzlits, mus) pairs,
+# using one pool for all of them. Returns a list of proven literals for each pair.
+def checkWhichLitsMUSesProve(solver, checks, config):
     setChildSolver(solver)
-    if len(puzlits) > 0:
+    proven = []
+    unsettled = []
+    for (puzlits, mus) in checks:
+        if EXPCONFIG["usePropagation"]:
+            (p, u) = propagateWhichLitsMUSProves(solver, puzlits, mus)
+        else:
+            (p, u) = ([], list(puzlits))
+        proven.append(set(p))
+        unsettled.append(u)
+
+    args = [(p, mus, config) for ((_, mus), u) in zip(checks, unsettled) for p in u]
+    logging.info(
+        "Checking %s MUSes: %s literals settled by propagation and models, %s by SAT",
+        len(checks),
+        sum(len(puzlits) for (puzlits, _) in checks) - len(args),
+        len(args),
+    )
+    if len(args) > 0:
         with getPool(config["cores"]) as pool:
-            res = pool.map(_parfunc_dochecklitsmus, [(p, mus, config) for p in puzlits])
-            return list(p for (p, musvalid) in res if musvalid)
-    else:
-        return []
+            res = iter(pool.map(_parfunc_dochecklitsmus, args))
+        # Results come back in the same order as args
+        for (i, u) in enumerate(unsettled):
+            proven[i].update(p for (p, musvalid) in itertools.islice(res, len(u)) if musvalid)
 
+    return [[p for p in puzlits if p in provenset] for ((puzlits, _), provenset) in zip(checks, proven)]
 
-MUSSizeFound = None
-MUSSizeRequired = None
 
 MAX_MUS = 999999999
 
 
+# True once some worker has found a MUS as small as the one we are looking for
+def _targetMUSFound():
+    return getSharedInt("MUSSizeFound").value <= getSharedInt("MUSSizeRequired").value
+
+
 def _findSmallestMUS_func(tup):
     (p, randstr, minsize, config) = tup
+    MUSSizeFound = getSharedInt("MUSSizeFound")
 
-    logging.debug("YY %s %s %s %s", MUSSizeFound.value, MUSSizeRequired.value, minsize, p)
+    logging.debug("YY %s %s %s %s", MUSSizeFound.value, getSharedInt("MUSSizeRequired").value, minsize, p)
 
-    if config["earlyExit"] and MUSSizeFound.value <= MUSSizeRequired.value:
-        logging.info("Early Exit!")
-        return (p, None)
+    # Drop queued jobs, and stop running ones, once the target is found
+    if config["earlyExit"]:
+        if _targetMUSFound():
+            logging.info("Early Exit!")
+            return (p, None)
+        cancel = _targetMUSFound
+    else:
+        cancel = None
 
     # logging.info("Random str: '%s'", randstr)
+    solver = getChildSolver()
     (ret, mus) = (
         p,
         MUS(
             randomFromSeed(randstr),
-            getChildSolver(),
-            [p.neg()],
+            solver,
+            [solver.negLitId(p)],
             minsize,
             config=config,
+            cancel=cancel,
         ),
     )
     if mus is not None:
@@ -488,13 +823,14 @@ def _findSmallestMUS_func(tup):
 def cascadeMUS(solver, puzlits, repeats, musdict, config):
     # We need this to be accessible by the pool
     setChildSolver(solver)
-    global MUSSizeFound, MUSSizeRequired
+    MUSSizeFound = getSharedInt("MUSSizeFound")
+    MUSSizeRequired = getSharedInt("MUSSizeRequired")
     if musdict.minimum() < math.inf:
-        MUSSizeFound = multiprocessing.Value('l', musdict.minimum())
+        MUSSizeFound.value = musdict.minimum()
     else:
-        MUSSizeFound = multiprocessing.Value('l', MAX_MUS)
+        MUSSizeFound.value = MAX_MUS
 
-    MUSSizeRequired = multiprocessing.Value('l', 111)
+    MUSSizeRequired.value = 111
 
     def inner_loop(minsize, pool):
         logging.info("Looking for %s (know %s)", minsize, MUSSizeFound.value)
@@ -503,26 +839,35 @@ def cascadeMUS(solver, puzlits, repeats, musdict, config):
             logging.info("Early exit because MUS already known")
             return True
 
+        # Literals which already have a MUS this small (usually carried over
+        # from the last step) don't need searching again
+        searchlits = [
+            p
+            for p in puzlits
+            if not (musdict.contains(p) and len(musdict.get(p)[0]) <= minsize)
+        ]
+
         # Do 'range(repeats)' first, so when we distribute we get an
         # even spread of literals on different cores minsize+1 for MUS
         # size, as the MUS will include 'p'
         logging.info(
-            "Considering %s * %s jobs for minsize=%s",
+            "Considering %s * %s jobs for minsize=%s (%s already found)",
             repeats,
-            len(puzlits),
+            len(searchlits),
             minsize,
+            len(puzlits) - len(searchlits),
         )
         res = pool.map(
             _findSmallestMUS_func,
             [
                 (
                     p,
-                    "{}:{}:{}".format(r, p, minsize),
+                    "{}:{}:{}".format(r, solver._idlits[p], minsize),
                     minsize * config["cascadeMult"],
                     config,
                 )
                 for r in range(repeats)
-                for p in puzlits
+                for p in searchlits
             ],
         )
         for (p, mus) in res:
@@ -547,13 +892,22 @@ def cascadeMUS(solver, puzlits, repeats, musdict, config):
 
     loop = config["baseSizeMUS"]
     loopend = max(loop + 1, 100000)
+    # The MUSes we already have (from the tiny MUS search, or carried over
+    # from the last step) are upper bounds, so never look for anything bigger
+    loopend = min(loopend, musdict.minimum())
+    loop = min(loop, loopend)
 
     with getPool(config["cores"]) as my_pool:
         while loop <= loopend: #loop represents the size of mus we are currently looking for
             ret = inner_loop(loop, my_pool) # each time we go into inner loop we try to find a mus of size at least loop
             if ret:
                 return
-            loop = max(loop + config["MUSaddStep"], int(loop * config["MUSmultStep"]))
+            if loop == loopend:
+                return
+            loop = min(
+                max(loop + config["MUSaddStep"], int(loop * config["MUSmultStep"])),
+                loopend,
+            )
 
 
 class CascadeMUSFinder:
@@ -561,8 +915,56 @@ class CascadeMUSFinder:
         self.config = config
         self._solver = solver
         self._bestcache = MusDict({})
+        # The known literals when _bestcache was stored
+        self._bestcacheknown = SortedSet()
+        self._diskcache = MUSCache(solver, "cascade", config)
+
+    # Finders saved by older versions have no disk cache, or known
+    # literals for their cache
+    def __setstate__(self, d):
+        self.__dict__ = d
+        if "_bestcacheknown" not in d:
+            self._bestcacheknown = SortedSet()
+        if "_diskcache" not in d:
+            self._diskcache = MUSCache(self._solver, "cascade", self.config)
+
+    # The cache, to pass to a copy of this finder in another process
+    def cacheState(self):
+        return (self._bestcache, self._bestcacheknown)
+
+    def setCacheState(self, state):
+        (self._bestcache, self._bestcacheknown) = state
+
+    def _setCache(self, musdict):
+        self._bestcache = copy.deepcopy(musdict)
+        self._bestcacheknown = SortedSet(self._solver.getKnownLits())
+
+    # Add the cached MUSes to musdict. As long as known literals have only been
+    # added since the cache was stored, the cached MUSes are still cores and
+    # just need a cheap re-minimisation; otherwise check them in full.
+    def _checkCache(self, puzlits, musdict):
+        known = SortedSet(self._solver.getKnownLits())
+        if known.issuperset(self._bestcacheknown):
+            recheckMUS(
+                self._solver,
+                puzlits,
+                self._bestcache,
+                musdict,
+                self.config,
+            )
+        else:
+            checkMUS(self._solver, puzlits, self._bestcache, musdict, self.config)
 
     def smallestMUS(self, puzlits):
+        musdict = self._diskcache.lookup(puzlits)
+        if musdict is not None:
+            self._setCache(musdict)
+            return musdict
+        musdict = self._smallestMUS(puzlits)
+        self._diskcache.store(puzlits, musdict)
+        return musdict
+
+    def _smallestMUS(self, puzlits):
         musdict = MusDict({})
         if self.config["checkSmall1"]:
             logging.info("Doing checkSmall1")
@@ -600,12 +1002,12 @@ class CascadeMUSFinder:
         # Early exit for trivial case
         if musdict.minimum() <= self.config["baseSizeMUS"] and self.config["earlyExit"]:
             logging.info("Early exit from checkSmall general")
-            self._bestcache = copy.deepcopy(musdict)
+            self._setCache(musdict)
             return musdict
 
         logging.info("Checking cache")
         if EXPCONFIG["useCache"]:
-            checkMUS(self._solver, puzlits, self._bestcache, musdict, self.config)
+            self._checkCache(puzlits, musdict)
 
         if self.config["checkSmall2"]:
             logging.info("Doing checkSmall2")
@@ -622,7 +1024,7 @@ class CascadeMUSFinder:
         # Early exit for trivial case
         if musdict.minimum() <= self.config["baseSizeMUS"] and self.config["earlyExit"]:
             logging.info("Early exit from checkSmall2 general")
-            self._bestcache = copy.deepcopy(musdict)
+            self._setCache(musdict)
             return musdict
 
         logging.info("Running cascade algorithm")
@@ -630,6 +1032,6 @@ class CascadeMUSFinder:
 
         logging.info("Finished CascadeMUS: Found %s", musdict.minimum())
 
-        self._bestcache = copy.deepcopy(musdict)
+        self._setCache(musdict)
 
         return musdict
@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+from .config import EXPCONFIG
+from .musdict import MusDict
+
+"""
+    MUSCache stores the MUSes found at each step on disk, so running the same
+    puzzle again (with the same config) can reload them instead of searching.
+
+    Each entry is keyed by a hash of the CNF, the constraint selectors, the
+    config, the known literals and the literals being explained. Literals are
+    stored as SAT literals, and MUSes as lists of constraint selectors, rather
+    than the solver's ids for them. The cache directory is kept
+    below EXPCONFIG["musCacheSize"] bytes, by deleting the least recently
+    used entries.
+"""
+
+
+class MUSCache:
+    def __init__(self, solver, finder, config):
+        self._solver = solver
+        self._dir = EXPCONFIG["musCacheDir"]
+        self._fingerprint = None
+        self._finder = finder
+        self._config = config
+        # Only pysat solvers have integer literals we can store
+        if self._dir is not None and not hasattr(solver._cnf, "clauses"):
+            logging.info("MUS cache needs a CNF solver, disabling")
+            self._dir = None
+
+    def enabled(self):
+        return self._dir is not None
+
+    # Hash of everything which doesn't change between steps. This is built
+    # lazily, as it has to walk the whole CNF.
+    def fingerprint(self):
+        if self._fingerprint is None:
+            h = hashlib.sha256()
+            h.update(self._finder.encode())
+            h.update(json.dumps(self._config, sort_keys=True, default=str).encode())
+            for clause in self._solver._cnf.clauses:
+                h.update(" ".join(map(str, clause)).encode())
+                h.update(b"\n")
+            for (lit, con) in sorted(self._solver._conmap.items()):
+                h.update("{} {} {}\n".format(lit, con, con.clauseset()).encode())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def _path(self, puzlits):
+        varmap = self._solver._varlit2smtmap
+        h = hashlib.sha256(self.fingerprint().encode())
+        known = sorted(varmap[l] for l in self._solver.getKnownLits())
+        h.update(("K" + " ".join(map(str, known))).encode())
+        lits = sorted(self._solver._idsmt[p] for p in puzlits)
+        h.update(("P" + " ".join(map(str, lits))).encode())
+        return os.path.join(self._dir, h.hexdigest() + ".json")
+
+    # Return the cached MusDict for 'puzlits' (a list of lit ids), or None
+    def lookup(self, puzlits):
+        if not self.enabled():
+            return None
+        path = self._path(puzlits)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        solver = self._solver
+        litmap = {solver._idsmt[p]: p for p in puzlits}
+        musdict = MusDict({})
+        try:
+            for (lit, muses) in data:
+                for mus in muses:
+                    musdict.update(litmap[lit], [solver._selconids[c] for c in mus])
+        except (KeyError, TypeError, ValueError):
+            logging.info("MUS cache entry %s is corrupt", path)
+            self._remove(path)
+            return None
+
+        if len(musdict) > 0:
+            # Check one MUS really is a core, in case of hash collisions
+            (p, muses) = min(musdict.items(), key=lambda x: len(x[1][0]))
+            smtassume = [solver._idsmt[solver.negLitId(p)]]
+            cons = [solver._conidsels[c] for c in muses[0]]
+            if solver.basicCore(smtassume + cons) is None:
+                logging.info("MUS cache entry %s is invalid", path)
+                self._remove(path)
+                return None
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        logging.info("Loaded %s MUSes from cache", len(musdict))
+        return musdict
+
+    def store(self, puzlits, musdict):
+        if not self.enabled():
+            return
+        solver = self._solver
+        data = [
+            (
+                solver._idsmt[p],
+                [[solver._conidsels[c] for c in mus] for mus in muses],
+            )
+            for (p, muses) in musdict.items()
+        ]
+        path = self._path(puzlits)
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            # Write then rename, so other runs never see half an entry
+            (fd, tmp) = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning("Unable to write MUS cache: %s", e)
+            return
+        self.evict()
+
+    # Delete the least recently used entries, until the cache fits
+    def evict(self):
+        entries = []
+        for name in os.listdir(self._dir):
+            if name.endswith(".json"):
+                try:
+                    st = os.stat(os.path.join(self._dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= EXPCONFIG["musCacheSize"]:
+                break
+            self._remove(os.path.join(self._dir, name))
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
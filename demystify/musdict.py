@@ -1,9 +1,9 @@
 import logging
 import math
-from demystify.base import Lit, DummyClause
 
 class MusDict(dict):
-    # Expects dict of form {Lit:[(DummyClause,)]}
+    # Expects dict of form {lit id:[(constraint id,)]}, using the solver's
+    # integer ids for literals and constraints
     def __init__(self, mus_dict={}):
         for k, v in mus_dict.items():
             self[k] = v
@@ -49,7 +49,7 @@ class MusDict(dict):
 
         return min(len(v[0]) for v in self.values())
 
-    def update(self, p:Lit, mus:[DummyClause]):
+    def update(self, p:int, mus:[int]):
         if mus is None:
             return
 
@@ -10,6 +10,8 @@ from .mus import getTinyMUSes
 from .optuxext import OptUxExt
 from .utils import flatten
 from .musdict import MusDict
+from .muscache import MUSCache
+from .config import EXPCONFIG
 from .parallel import (
     getPool,
     setChildSolver,
@@ -29,6 +31,7 @@ class ForqesMUSFinder:
         self.config = config
         self._solver = solver
         self._bestcache = {}
+        self._diskcache = MUSCache(solver, "forqes", config)
 
         # The constraint selectors
         cons = list(solver._conlits)
@@ -54,6 +57,13 @@ class ForqesMUSFinder:
             minz=True,
         )
 
+    # FORQES keeps no cache between steps
+    def cacheState(self):
+        return None
+
+    def setCacheState(self, state):
+        pass
+
     def smallestMUS(self, puzlits):
         """
         This method should return the smallest MUSes among problems of the
@@ -61,6 +71,13 @@ class ForqesMUSFinder:
         known literals, l is some literal and a is some value in the known
         solution.
         """
+        musdict = self._diskcache.lookup(puzlits)
+        if musdict is None:
+            musdict = self._smallestMUS(puzlits)
+            self._diskcache.store(puzlits, musdict)
+        return musdict
+
+    def _smallestMUS(self, puzlits):
         musdict = MusDict({})
 
         # Heuristic check for MUSes of size 1.
@@ -95,6 +112,8 @@ def forqesMUS(solver, forqes, puzlits, musdict, config):
     """
 
     # Make the solver and forqes objects accessible by child processes.
+    # FORQES objects cannot be copied, so workers must be forked.
+    assert EXPCONFIG["poolStartMethod"] == "fork"
     setChildSolver(solver)
     setChildForqes(forqes)
 
@@ -122,10 +141,11 @@ def _findSmallestMUS_func(tup):
     Function to allow parallelisation.
     """
     (p, config, maxSize) = tup
+    solver = getChildSolver()
     mus = MUS(
-        getChildSolver(),
+        solver,
         getChildForqes(),
-        [p.neg()],
+        [solver.negLitId(p)],
         config=config,
         maxSize=maxSize,
     )
@@ -143,7 +163,7 @@ def MUS(solver, forqes, assume, config, maxSize=float("inf")):
     """
 
     # The negation of a literal we know to be in the solution
-    assume = [solver._varlit2smtmap[a] for a in assume]
+    assume = [solver._idsmt[a] for a in assume]
 
     # The solution values we have already explained
     known = [k for k in solver._solver._knownlits]
@@ -161,6 +181,6 @@ def MUS(solver, forqes, assume, config, maxSize=float("inf")):
     # FORQES returns indices of soft clauses (constraint selectors)
     bestMUS = flatten([forqes.formula.soft[i - 1] for i in softClauseIndices])
 
-    result = [solver._conmap[x] for x in bestMUS if x in solver._conmap]
+    result = [solver._selconids[x] for x in bestMUS if x in solver._selconids]
 
     return result
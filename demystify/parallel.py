@@ -1,16 +1,27 @@
+import atexit
+import gc
 import itertools
 import random
 import logging
+import math
+import time
 import sys, os
 
-from multiprocessing import Pool, Process, get_start_method, Queue
+from multiprocessing import Pool, Process, get_start_method, get_context, Queue, Barrier
+from multiprocessing import shared_memory
 
 from .config import EXPCONFIG
 from .utils import randomFromSeed
+from .snapshot import layout_snapshot, loads_snapshot
 
 # Needs to be global so we can call it from a child process
 _global_solver_ref = None
 _global_forqes_ref = None
+# Shared memory holding the solver, in workers started by spawn or forkserver
+_worker_shm = None
+# The solver published for workers started by spawn or forkserver, as
+# (solver, shared memory)
+_published = None
 
 
 def getChildSolver():
@@ -22,6 +33,28 @@ def setChildSolver(c):
     _global_solver_ref = c
 
 
+# Integers shared between the main process and the pool workers, for
+# example so workers can stop once a small enough MUS is found. Workers
+# started by spawn or forkserver can only be given these when they start,
+# so they are made (once, for each start method) before any pool.
+SHARED_INTS = ("MUSSizeFound", "MUSSizeRequired")
+_shared_ints = {}
+
+
+def getSharedInt(name):
+    method = EXPCONFIG["poolStartMethod"]
+    if method not in _shared_ints:
+        ctx = get_context(method)
+        _shared_ints[method] = {n: ctx.Value("l", 0) for n in SHARED_INTS}
+    return _shared_ints[method][name]
+
+
+# Forget the shared integers, so this process and its pools get new ones.
+# Used by forked processes which may be killed while holding their locks.
+def resetSharedInts():
+    _shared_ints.clear()
+
+
 def getChildForqes():
     return _global_forqes_ref
 
@@ -31,14 +64,17 @@ def setChildForqes(c):
     _global_forqes_ref = c
 
 
-# Magic from https://stackoverflow.com/questions/2130016/splitting-a-list-into-n-parts-of-approximately-equal-length
-def split(a, n):
-    k, m = divmod(len(a), n)
-    # Listify this so we check the lengths here
-    return list(
-        list(a[i * k + min(i, m): (i + 1) * k + min(i + 1, m)])
-        for i in range(n)
-    )
+# Guided scheduling: cut 'n' jobs into batches which start at about
+# 1/(factor*processes) of the jobs and shrink to single jobs, so the
+# slow stragglers at the end of a map get spread over all the workers.
+def guidedBatches(n, processes, factor):
+    batches = []
+    start = 0
+    while start < n:
+        size = max(1, math.ceil((n - start) / (processes * factor)))
+        batches.append((start, min(n, start + size)))
+        start += size
+    return batches
 
 
 # Fake Pool for profiling with py-spy
@@ -67,6 +103,8 @@ def getPool(cores):
             global _reuse_process_pool
             if _reuse_process_pool is None:
                 _reuse_process_pool = ProcessPool(processes=cores, reuse=True)
+                # Stop the workers, or exiting waits for them forever
+                atexit.register(_reuse_process_pool.cleanup)
             return _reuse_process_pool
         else:
             return ProcessPool(processes=cores)
@@ -82,29 +120,93 @@ def getGlobalProcessCounter():
     return global_process_counter
 
 
-def doprocess(id, inqueue, outqueue):
-    count = 0
+def doprocess(id, taskqueue, outqueue, barrier):
     # logging.info("start child stats: %s", _global_solver_ref.get_stats())
     _global_solver_ref.reset_stats()
     # logging.info("reset child stats: %s", _global_solver_ref.get_stats())
+    lastknown = None
     while True:
         # print("! {} Waiting for task".format(id))
-        (func, msg) = inqueue.get()
-        # print("! {} Got task {} {}".format(id,count, (func,msg)))
+        (func, msg, known) = taskqueue.get()
         if func is None:
             if msg == "stats":
                 # logging.info("get child stats: %s", _global_solver_ref.get_stats())
                 outqueue.put({"stats": _global_solver_ref.get_stats()})
                 _global_solver_ref.reset_stats()
+                # Every worker must answer exactly one stats request, so
+                # don't take another message until everyone has one.
+                barrier.wait()
             elif msg is None:
                 break
             else:
                 print("Invalid message to child")
                 sys.exit(1)
         else:
-            outqueue.put(func(msg))
-        # print("! {} Done task {}".format(id,count))
-        count += 1
+            # 'msg' is a batch of (position, argument) pairs. 'known' is the
+            # ids of the main process's known literals, if our copy of the
+            # solver may be older than that
+            if known is not None and known != lastknown:
+                _global_solver_ref.setKnownLitIds(known)
+                lastknown = known
+            start_time = time.perf_counter()
+            answers = [(i, func(arg)) for (i, arg) in msg]
+            outqueue.put((id, time.perf_counter() - start_time, answers))
+
+
+# Entry point of workers started by spawn or forkserver. These share
+# nothing with the main process, so first load the solver it published in
+# shared memory, and copy its EXPCONFIG and shared integers.
+def startprocess(id, taskqueue, outqueue, barrier, shmname, expconfig, sharedints):
+    global _worker_shm
+    EXPCONFIG.update(expconfig)
+    _shared_ints[EXPCONFIG["poolStartMethod"]] = sharedints
+    # Arrays in the solver are views of this memory, so keep it open
+    _worker_shm = shared_memory.SharedMemory(name=shmname)
+    setChildSolver(loads_snapshot(_worker_shm.buf))
+    doprocess(id, taskqueue, outqueue, barrier)
+    # The memory can only be closed once nothing uses it
+    setChildSolver(None)
+    gc.collect()
+    _worker_shm.close()
+
+
+# Copy 'obj' into a new block of shared memory, as a snapshot
+def publish(obj):
+    (size, parts) = layout_snapshot(obj)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for (start, data) in parts:
+        shm.buf[start : start + len(data)] = data
+    return shm
+
+
+# Return the shared memory holding 'solver', publishing it if needed. The
+# clauses and literal / constraint maps do not change, so this is done once
+# for each solver, and workers are sent the known literals with each batch.
+def getPublishedSolver(solver):
+    global _published
+    if _published is None or _published[0] is not solver:
+        unpublish()
+        publish_time = time.perf_counter()
+        _published = (solver, publish(solver))
+        logging.info(
+            "Published solver: %s bytes, %.2fs",
+            _published[1].size,
+            time.perf_counter() - publish_time,
+        )
+    return _published[1]
+
+
+# Free the published copy of 'solver' (or of any solver), for example when
+# something has been added which workers should not build for themselves
+def unpublish(solver=None):
+    global _published
+    if _published is not None and (solver is None or _published[0] is solver):
+        _published[1].close()
+        _published[1].unlink()
+        _published = None
+
+
+atexit.register(unpublish)
 
 
 class ProcessPool:
@@ -113,64 +215,90 @@ class ProcessPool:
         self._processcount = processes
         self._reuse = reuse
         self._first = True
+        # Time each worker spent running jobs, and how many jobs it ran
+        self._busytime = [0.0] * processes
+        self._jobcount = [0] * processes
+        self._maptime = 0.0
 
     def map(self, func, args):
         # Make this repeatable, but shuffled differently on each call
         randomFromSeed(getGlobalProcessCounter()).shuffle(args)
-        # TODO: This can be unbalanced
-        chunks = split(args, self._processcount)
-        logging.info("Chunked %s in %s", len(args), [len(c) for c in chunks])
-        # print("!A ", chunks)
-        # Push all the work
-        for i, chunk in enumerate(chunks):
-            for c in chunk:
-                # print("! Putting task {} for {}".format(i, c))
-                self._inqueues[i].put((func, c))
-
-        results = []
-        for i, q in enumerate(self._outqueues):
-            l = []
-            # Get one answer for each thing in the chunk
-            for _ in chunks[i]:
-                x = q.get()
-                # print("!X got ", i, x)
-                l.append(x)
-            results.append(l)
-
-        # print("!Ax {} {} {} {} {}".format(len(args), sum([len(c) for c in chunks]), sum([len(r) for r in results]), [len(c) for c in chunks], [len(r) for r in results]))
-        if len(list(itertools.chain(*results))) != len(args):
+        # All workers pull from one queue, so a few slow jobs do not leave
+        # the other workers idle while one works through a fixed chunk.
+        batches = guidedBatches(len(args), self._processcount, EXPCONFIG["poolBatchFactor"])
+        logging.info("Batched %s in %s", len(args), [e - s for (s, e) in batches])
+        # Workers which were not forked just now need the known literals
+        if self._sendknown:
+            known = _global_solver_ref.knownLitIds()
+        else:
+            known = None
+        start_time = time.perf_counter()
+        for (start, end) in batches:
+            self._taskqueue.put((func, [(i, args[i]) for i in range(start, end)], known))
+
+        missing = object()
+        results = [missing] * len(args)
+        busy = [0.0] * self._processcount
+        jobs = [0] * self._processcount
+        for _ in batches:
+            (worker, worktime, answers) = self._outqueue.get()
+            busy[worker] += worktime
+            jobs[worker] += len(answers)
+            for (i, x) in answers:
+                results[i] = x
+
+        if any(r is missing for r in results):
             logging.error(
-                "Missing answers: {} {} {} {}".format(
-                    [len(r) for r in results],
-                    [len(c) for c in chunks],
-                    sum([len(c) for c in chunks]),
-                    len(args),
+                "Missing answers: {} of {}".format(
+                    sum(r is missing for r in results), len(args)
                 )
             )
-            assert len(list(itertools.chain(*results))) == len(args)
-        # print("!B ", results)
-        # print("!C", list(itertools.chain(*results)))
-        return list(itertools.chain(*results))
+            assert not any(r is missing for r in results)
+
+        elapsed = time.perf_counter() - start_time
+        self._maptime += elapsed
+        for i in range(self._processcount):
+            self._busytime[i] += busy[i]
+            self._jobcount[i] += jobs[i]
+        logging.info(
+            "Pool map: %s jobs, %.2fs, worker jobs %s, worker utilisation %s",
+            len(args),
+            elapsed,
+            jobs,
+            ["{:.0%}".format(b / elapsed) if elapsed > 0 else "-" for b in busy],
+        )
+        # Return answers in the same order as the (shuffled) arguments
+        return results
+
+    # Fraction of the time spent in 'map' that each worker was running jobs
+    def utilisation(self):
+        if self._maptime == 0:
+            return [0.0] * self._processcount
+        return [b / self._maptime for b in self._busytime]
 
     def __enter__(self):
-        assert get_start_method() == "fork"
         assert self._reuse or self._first
 
         if self._first:
             ## print("! enter")
-            self._inqueues = [Queue() for i in range(self._processcount)]
-            self._outqueues = [Queue() for i in range(self._processcount)]
-            self._processes = [
-                Process(
-                    target=doprocess,
-                    args=(
-                        getGlobalProcessCounter(),
-                        self._inqueues[i],
-                        self._outqueues[i],
-                    ),
+            method = EXPCONFIG["poolStartMethod"]
+            ctx = get_context(method)
+            self._taskqueue = ctx.Queue()
+            self._outqueue = ctx.Queue()
+            self._barrier = ctx.Barrier(self._processcount)
+            args = [(i, self._taskqueue, self._outqueue, self._barrier) for i in range(self._processcount)]
+            # Forked workers inherit the solver as it is now. A reused pool
+            # outlives that, and other workers load the published solver.
+            self._sendknown = self._reuse or method != "fork"
+            if method == "fork":
+                self._processes = [ctx.Process(target=doprocess, args=a) for a in args]
+            else:
+                extra = (
+                    getPublishedSolver(_global_solver_ref).name,
+                    dict(EXPCONFIG),
+                    {n: getSharedInt(n) for n in SHARED_INTS},
                 )
-                for i in range(self._processcount)
-            ]
+                self._processes = [ctx.Process(target=startprocess, args=a + extra) for a in args]
             for p in self._processes:
                 p.start()
             self._first = False
@@ -179,18 +307,23 @@ class ProcessPool:
     # Clean up
     def __exit__(self, a, b, c):
         # print("!! exiting")
-        for q in self._inqueues:
-            q.put((None, "stats"))
-        for q in self._outqueues:
-            s = q.get()
+        for _ in self._processes:
+            self._taskqueue.put((None, "stats", None))
+        for _ in self._processes:
+            s = self._outqueue.get()
             # logging.info("child stats: %s", s)
             _global_solver_ref.add_stats(s["stats"])
+        logging.info(
+            "Pool worker jobs %s, utilisation %s",
+            self._jobcount,
+            ["{:.0%}".format(u) for u in self.utilisation()],
+        )
         if not self._reuse:
             self.cleanup()
         return False
 
     def cleanup(self):
-        for q in self._inqueues:
-            q.put((None, None))
+        for _ in self._processes:
+            self._taskqueue.put((None, None, None))
         for p in self._processes:
             p.join()
@@ -5,6 +5,8 @@ import subprocess
 import re
 import logging
 import tempfile
+import hashlib
+import shutil
 
 from sortedcontainers import SortedSet
 from pysat.formula import CNF
@@ -15,12 +17,19 @@ import demystify
 import demystify.base
 import demystify.internal
 import demystify.buildpuz
+import demystify.config
 
 
 class ParseError(Exception):
     pass
 
 
+# Variables in JSON puzzles are named by their (1-based) position. This is
+# not a lambda, so puzzles can be pickled (for snapshots, and spawned workers)
+def _json_var_name(t):
+    return (t[0] + 1, t[1] + 1)
+
+
 def parse_json(puzzle_json):
     varmap = {}
     varlist = []
@@ -28,9 +37,7 @@ def parse_json(puzzle_json):
     with open(puzzle_json) as json_data:
         d = json.load(json_data)
         for (name, (x, y, dom)) in d["vars"].items():
-            v = demystify.base.VarMatrix(
-                lambda t: (t[0] + 1, t[1] + 1), (x, y), dom
-            )
+            v = demystify.base.VarMatrix(_json_var_name, (x, y), dom)
             varmap[name] = v
             varlist.append(v)
 
@@ -58,9 +65,26 @@ def parse_json(puzzle_json):
         return puz, solver
 
 
-def parse_essence(eprime, eprimeparam):
-    varmap = {}
-    varlist = []
+# Options given to savilerow, after the input files
+SAVILEROW_FLAGS = [
+    "-sat-output-mapping",
+    "-sat",
+    "-sat-family",
+    "lingeling",
+    "-S0",
+    "-O0",
+    "-reduce-domains",
+    "-aggregate",
+]
+
+# Change this when the files stored in the essence cache change
+ESSENCE_CACHE_VERSION = "1"
+
+
+# Run conjure and savilerow on a model and parameter file, writing the
+# DIMACS (with savilerow's mapping comments) to 'dimacs'. Returns the
+# parameters, as JSON.
+def run_essence_tools(eprime, eprimeparam, dimacs):
     paramjson = subprocess.run(
         ["conjure", "pretty", "--output-format", "json", eprimeparam],
         stdout=subprocess.PIPE,
@@ -77,45 +101,31 @@ def parse_essence(eprime, eprimeparam):
         )
     params = json.loads(paramjson.stdout)
 
-    tdir = None
-
-    if eprime.endswith(".essence"):
-        tdir = tempfile.TemporaryDirectory()
-        conjure = subprocess.run(["conjure", "modelling", "-o", tdir.name, eprime],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE, )
-        if conjure.returncode != 0:
-            raise ParseError(
-                "conjure failed"
-                + "\n"
-                + conjure.stdout.decode("utf-8")
-                + "\n"
-                + conjure.stderr.decode("utf-8")
-            )
-        eprimefilename = tdir.name + "/model000001.eprime"
-    else:
-        eprimefilename = eprime
-
-    makedimacs = subprocess.run(
-        [
-            "savilerow",
-            "-in-eprime",
-            eprimefilename,
-            "-in-param",
-            eprimeparam,
-            "-sat-output-mapping",
-            "-sat",
-            "-sat-family",
-            "lingeling",
-            "-S0",
-            "-O0",
-            "-reduce-domains",
-            "-aggregate",
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=(os.name == 'nt')
-    )
+    with tempfile.TemporaryDirectory() as tdir:
+        if eprime.endswith(".essence"):
+            conjure = subprocess.run(["conjure", "modelling", "-o", tdir, eprime],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, )
+            if conjure.returncode != 0:
+                raise ParseError(
+                    "conjure failed"
+                    + "\n"
+                    + conjure.stdout.decode("utf-8")
+                    + "\n"
+                    + conjure.stderr.decode("utf-8")
+                )
+            eprimefilename = tdir + "/model000001.eprime"
+        else:
+            eprimefilename = eprime
+
+        makedimacs = subprocess.run(
+            ["savilerow", "-in-eprime", eprimefilename, "-in-param", eprimeparam]
+            + SAVILEROW_FLAGS
+            + ["-out-sat", dimacs],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=(os.name == 'nt')
+        )
 
     if makedimacs.returncode != 0:
         raise ParseError(
@@ -126,10 +136,116 @@ def parse_essence(eprime, eprimeparam):
             + makedimacs.stderr.decode("utf-8")
         )
 
-    formula = CNF(from_file=eprimeparam + ".dimacs")
+    return params
+
+
+# The cache entry for a model and parameter file: a hash of their contents
+# and of how we run the tools
+def essence_cache_key(eprime, eprimeparam):
+    h = hashlib.sha256()
+    h.update(ESSENCE_CACHE_VERSION.encode())
+    h.update(b"essence" if eprime.endswith(".essence") else b"eprime")
+    h.update(" ".join(SAVILEROW_FLAGS).encode())
+    for filename in (eprime, eprimeparam):
+        with open(filename, "rb") as f:
+            data = f.read()
+        h.update(str(len(data)).encode() + b"\n" + data)
+    return h.hexdigest()
+
+
+# Returns (params, dimacs filename, temporary directory or None).
+# If EXPCONFIG["essenceCacheDir"] is set, the outputs of conjure and
+# savilerow are kept there, so they only have to be run once for each
+# model and parameter file. Each entry is a directory, which is built
+# under a temporary name and renamed into place, so concurrent runs never
+# see half an entry (and if two runs build the same entry, one is kept).
+def cached_essence_tools(eprime, eprimeparam):
+    cachedir = demystify.config.EXPCONFIG["essenceCacheDir"]
+    if cachedir is None:
+        tdir = tempfile.TemporaryDirectory()
+        dimacs = os.path.join(tdir.name, "model.dimacs")
+        params = run_essence_tools(eprime, eprimeparam, dimacs)
+        return (params, dimacs, tdir)
+
+    entry = os.path.join(cachedir, essence_cache_key(eprime, eprimeparam))
+    dimacs = os.path.join(entry, "model.dimacs")
+    try:
+        with open(os.path.join(entry, "params.json")) as f:
+            params = json.load(f)
+        if os.path.exists(dimacs):
+            logging.info("Using cached savilerow output %s", entry)
+            return (params, dimacs, None)
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(cachedir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cachedir, prefix=".tmp")
+    try:
+        params = run_essence_tools(eprime, eprimeparam, os.path.join(tmp, "model.dimacs"))
+        with open(os.path.join(tmp, "params.json"), "w") as f:
+            json.dump(params, f)
+        os.rename(tmp, entry)
+    except OSError:
+        # Another run stored this entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(dimacs):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return (params, dimacs, None)
+
+
+# Read the DIMACS output of savilerow in one pass, returning the CNF and
+# two maps (for direct and order encodings) from each variable in
+# 'identifiers' to its indices, to its values, to a SAT variable.
+# These are found from the mapping comments, which look like:
+# c Var 'x_1_2' direct represents '3' with '17'
+def read_savilerow_dimacs(filename, identifiers, auxvars):
+    varmatch = re.compile("c Var '(.*)' (direct|order) represents '(.*)' with '(.*)'")
+    names = demystify.utils.PrefixSet(identifiers)
+    auxnames = demystify.utils.PrefixSet(auxvars)
+    varmap = dict()
+    ordervarmap = dict()
+    clauses = []
+    nv = 0
+    with open(filename) as sat_data:
+        for line in sat_data:
+            if line[0] == "c":
+                if not line.startswith("c Var"):
+                    continue
+                match = varmatch.match(line)
+                assert match is not None
+                # At the moment, only care about direct match
+                fillmap = varmap if match[2] == "direct" else ordervarmap
+
+                if not match[1].startswith("aux"):
+                    var = demystify.utils.parseSavileRowName(names, auxnames, match[1])
+
+                    if var is not None:
+                        fillmap.setdefault(var[0], dict()).setdefault(var[1], dict())[
+                            int(match[3])
+                        ] = int(match[4])
+            elif line[0] != "p":
+                # One clause per line, ending with 0
+                words = line.split()
+                if len(words) == 0:
+                    continue
+                clause = [int(x) for x in words[:-1]]
+                if len(clause) > 0:
+                    nv = max(nv, max(clause), -min(clause))
+                clauses.append(clause)
+
+    formula = CNF()
+    formula.clauses = clauses
+    formula.nv = nv
+    return (formula, varmap, ordervarmap)
+
 
-    dvarmatch = re.compile("c Var '(.*)' direct represents '(.*)' with '(.*)'")
-    ovarmatch = re.compile("c Var '(.*)' order represents '(.*)' with '(.*)'")
+def parse_essence(eprime, eprimeparam):
+    varmap = {}
+    varlist = []
+    (params, dimacs, tdir) = cached_essence_tools(eprime, eprimeparam)
 
     with open(eprime) as eprime_data:
         vars = SortedSet()
@@ -173,36 +289,8 @@ def parse_essence(eprime, eprimeparam):
 
     identifiers = SortedSet.union(vars, cons.keys())
 
-    with open(eprimeparam + ".dimacs") as sat_data:
-        varmap = dict()
-        ordervarmap = dict()
-        for line in sat_data:
-            if line.startswith("c Var"):
-                dmatch = dvarmatch.match(line)
-                omatch = ovarmatch.match(line)
-                assert dmatch is not None or omatch is not None
-                # At the moment, only care about direct match
-                if dmatch is not None:
-                    fillmap = varmap
-                    match = dmatch
-                else:
-                    fillmap = ordervarmap
-                    match = omatch
-
-                if not match[1].startswith("aux"):
-
-                    var = demystify.utils.parseSavileRowName(
-                        identifiers, auxvars, match[1]
-                    )
-
-                    if var is not None:
-                        if var[0] not in fillmap:
-                            fillmap[var[0]] = dict()
-                        if var[1] not in fillmap[var[0]]:
-                            fillmap[var[0]][var[1]] = dict()
-                        fillmap[var[0]][var[1]][int(match[2])] = int(match[3])
-
-        logging.debug(varmap)
+    (formula, varmap, ordervarmap) = read_savilerow_dimacs(dimacs, identifiers, auxvars)
+    logging.debug(varmap)
 
     printvarmap = dict()
     litmap = dict()
@@ -0,0 +1,123 @@
+import copyreg
+import io
+import mmap
+import pickle
+import struct
+
+from sortedcontainers import SortedSet
+
+"""
+    Snapshots save an Explainer (or any picklable object) to disk, so an
+    expensive setup (running savilerow, building the solver) can be reused.
+
+    The file is:
+        SNAPSHOT_MAGIC, then a header of (version, buffer count, pickle length)
+        the (offset, length) of each buffer
+        the pickle (protocol 5)
+        the buffers, each aligned to BUFFER_ALIGN bytes
+
+    Large numpy arrays (the packed CNF, and the literal / constraint tables)
+    are stored as out-of-band buffers. On load the file is memory-mapped, and
+    these arrays are read-only views of the map, so they are only read from
+    disk as they are used. Pool workers which are not forked get their
+    solver the same way, from a snapshot in shared memory.
+"""
+
+SNAPSHOT_MAGIC = b"DEMYSNAP"
+SNAPSHOT_VERSION = 1
+BUFFER_ALIGN = 64
+
+_HEADER = struct.Struct("<IIQ")
+_BUFFER = struct.Struct("<QQ")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# SortedSets normally pickle as an unordered set, and are sorted again when
+# loaded. There are many of them (of literals), so store them in order, which
+# sorting only has to check.
+def _sortedset(values):
+    s = SortedSet()
+    s._set.update(values)
+    s._list.update(values)
+    return s
+
+
+def _reduce_sortedset(s):
+    if s.key is not None:
+        return s.__reduce__()
+    return (_sortedset, (list(s),))
+
+
+def _pad(n):
+    return -n % BUFFER_ALIGN
+
+
+# Returns (size, parts), where the snapshot of 'obj' is 'size' bytes long
+# and 'parts' lists the (offset, bytes) to write. The gaps are padding.
+def layout_snapshot(obj):
+    buffers = []
+    out = io.BytesIO()
+    pickler = pickle.Pickler(out, protocol=5, buffer_callback=buffers.append)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    pickler.dispatch_table[SortedSet] = _reduce_sortedset
+    pickler.dump(obj)
+    data = out.getvalue()
+    views = [b.raw() for b in buffers]
+
+    offset = len(SNAPSHOT_MAGIC) + _HEADER.size + _BUFFER.size * len(views) + len(data)
+    table = []
+    for v in views:
+        offset += _pad(offset)
+        table.append((offset, v.nbytes))
+        offset += v.nbytes
+
+    header = b"".join(
+        [SNAPSHOT_MAGIC, _HEADER.pack(SNAPSHOT_VERSION, len(views), len(data))]
+        + [_BUFFER.pack(*entry) for entry in table]
+        + [data]
+    )
+    return (offset, [(0, header)] + [(start, v) for (v, (start, _)) in zip(views, table)])
+
+
+def save_snapshot(obj, filename):
+    (size, parts) = layout_snapshot(obj)
+    with open(filename, "wb") as f:
+        for (start, data) in parts:
+            f.write(b"\0" * (start - f.tell()))
+            f.write(data)
+
+
+def is_snapshot(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def load_snapshot(filename):
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads_snapshot(memoryview(mm), filename)
+
+
+# Load a snapshot from a buffer. Arrays in the result are views of 'view'.
+def loads_snapshot(view, name="snapshot"):
+    if bytes(view[: len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        raise SnapshotError("{} is not a snapshot".format(name))
+    pos = len(SNAPSHOT_MAGIC)
+    (version, count, length) = _HEADER.unpack_from(view, pos)
+    if version != SNAPSHOT_VERSION:
+        raise SnapshotError(
+            "{} is snapshot version {}, expected {}".format(name, version, SNAPSHOT_VERSION)
+        )
+    pos += _HEADER.size
+    buffers = []
+    for _ in range(count):
+        (start, size) = _BUFFER.unpack_from(view, pos)
+        pos += _BUFFER.size
+        buffers.append(view[start : start + size])
+    try:
+        return pickle.load(io.BytesIO(view[pos : pos + length]), buffers=buffers)
+    except (pickle.UnpicklingError, EOFError, ValueError) as e:
+        raise SnapshotError("{} is corrupt: {}".format(name, e))
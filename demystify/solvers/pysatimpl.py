@@ -1,5 +1,8 @@
+import collections
 import copy
+import itertools
 import logging
+import numpy
 from sortedcontainers import *
 
 from pysat.solvers import Solver
@@ -16,6 +19,27 @@ import random
 # print(inspect.getfile(pysat))
 
 
+# Pack a list of clauses into arrays (offsets, literals), where clause i
+# is literals[offsets[i]:offsets[i+1]]
+def _packClauses(clauses):
+    offsets = numpy.zeros(len(clauses) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(c) for c in clauses])
+    lits = numpy.fromiter(itertools.chain.from_iterable(clauses), dtype=numpy.int32, count=offsets[-1])
+    return (offsets, lits)
+
+
+# Iterate over the clauses in packed arrays, as lists
+def _iterPackedClauses(packed):
+    (offsets, lits) = packed
+    offsets = offsets.tolist()
+    lits = lits.tolist()
+    return (lits[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1))
+
+
+def _unpackClauses(packed):
+    return list(_iterPackedClauses(packed))
+
+
 class SATSolver:
     def __init__(self, cnf=None):
         if cnf is None:
@@ -23,20 +47,30 @@ class SATSolver:
             self._boolcount = 1
             self._clauses = []
         else:
-            self._boolcount = cnf.nv
+            # The next unused variable
+            self._boolcount = cnf.nv + 1
             self._solver = Solver(name=EXPCONFIG["solver"], incr=EXPCONFIG["solverIncremental"],
                                   bootstrap_with=cnf.clauses)
             self._clauses = cnf.clauses
 
+        # Known literals are added to the solver as unit clauses, so they do
+        # not have to be passed as assumptions to every solve. 'push' saves
+        # the known literals, and 'pop' rebuilds the solver if units have
+        # been added since, as they cannot be removed.
         self._stack = []
         self._boolnames = {}
         self._knownlits = SortedSet()
+        # Built on demand by 'occurrences'
+        self._occurs = None
         if EXPCONFIG["dumpSAT"]:
             assert (cnf is None)
             self._rawclauses = []
         self._lasttime = -1
+        # Propagations used by recent solveLimited calls which finished
+        self._recentprops = collections.deque(maxlen=EXPCONFIG["solveLimitedWindow"])
 
         self.reset_stats()
+        self._resetWatchdog()
 
     def Bool(self, name):
         newbool = self._boolcount
@@ -51,12 +85,14 @@ class SATSolver:
         return list(lits)
 
     def addConstraint(self, clause):
+        self._occurs = None
         self._clauses.append(clause)
         if EXPCONFIG["dumpSAT"]:
             self._rawclauses.append(clause)
         self._solver.add_clause(clause)
 
     def addImplies(self, var, clauses):
+        self._occurs = None
         for c in clauses:
             self._clauses.append(c + [-var])
             self._solver.add_clause(c + [-var])
@@ -64,23 +100,108 @@ class SATSolver:
                 assert len(clauses) == 1
                 self._rawclauses.append(c)
 
+    # Pickles store the clauses as two flat arrays (see _packClauses), and
+    # not the pysat solver. After unpickling, the solver is rebuilt straight
+    # from the arrays the first time it is used, by __getattr__. The clause
+    # lists are only rebuilt if something needs them (such as 'occurrences',
+    # as _occurs is not pickled either).
     def __getstate__(self):
-        self._solver.delete()
-        return self.__dict__.copy()
+        d = self.__dict__.copy()
+        d.pop("_solver", None)
+        if "_packedclauses" in d:
+            d["_clauses"] = d.pop("_packedclauses")
+        else:
+            d["_clauses"] = _packClauses(d["_clauses"])
+        d["_occurs"] = None
+        return d
 
     def __setstate__(self, d):
+        clauses = d.pop("_clauses")
+        # Older pickles stored the clauses as lists
+        if isinstance(clauses, tuple):
+            d["_packedclauses"] = clauses
+        else:
+            d["_clauses"] = clauses
+        # Older pickles also stored the (deleted) pysat solver, and fewer stats
+        d.pop("_solver", None)
+        d.setdefault("_occurs", None)
+        stats = d.get("_stats", {})
         self.__dict__ = d
-        self.reboot()
+        self.reset_stats()
+        self._stats.update(stats)
+        if "_recentprops" not in d:
+            self._recentprops = collections.deque(maxlen=EXPCONFIG["solveLimitedWindow"])
+        if "_watchcalls" not in d:
+            self._resetWatchdog()
 
-    # Recreate solver
-    def reboot(self):
-        self._solver.delete()
-        self._solver = Solver(
+    # Only called for attributes which are missing
+    def __getattr__(self, name):
+        if name == "_clauses" and "_packedclauses" in self.__dict__:
+            self._clauses = _unpackClauses(self.__dict__.pop("_packedclauses"))
+            return self._clauses
+        if name == "_solver" and "_knownlits" in self.__dict__:
+            self._solver = self._newSolver()
+            return self._solver
+        raise AttributeError(name)
+
+    def _newSolver(self):
+        if "_packedclauses" in self.__dict__:
+            clauses = _iterPackedClauses(self._packedclauses)
+        else:
+            clauses = self._clauses
+        return Solver(
             name=EXPCONFIG["solver"],
             incr=EXPCONFIG["solverIncremental"],
-            bootstrap_with=self._clauses
+            bootstrap_with=itertools.chain(clauses, [[l] for l in self._knownlits])
         )
 
+    # Recreate solver (pysat solvers do not take a seed, so it is ignored)
+    def reboot(self, seed=None):
+        if "_solver" in self.__dict__:
+            self._solver.delete()
+        self._solver = self._newSolver()
+        self._resetWatchdog()
+
+    # The solver keeps its learned clauses between calls (and, in a pool,
+    # between jobs). Usually this helps, but sometimes the solver gets
+    # bogged down. We count conflicts since the last reboot (each one adds
+    # a learned clause), and watch the propagations each solve needs. If
+    # we have learned a lot, and solves have got much more expensive than
+    # just after the reboot, we reboot.
+    def _resetWatchdog(self):
+        self._watchcalls = 0
+        self._watchconflicts = 0
+        self._watchbaseline = None
+        self._needreboot = False
+        self._watchrecent = collections.deque(maxlen=EXPCONFIG["solverRebootWindow"])
+
+    def _watchSolve(self, start_stats):
+        if not EXPCONFIG["solverIncremental"] or not EXPCONFIG["solverRebootSlowdown"]:
+            return
+        end_stats = self._solver.accum_stats()
+        self._watchcalls += 1
+        self._watchconflicts += end_stats["conflicts"] - start_stats["conflicts"]
+        self._watchrecent.append(end_stats["propagations"] - start_stats["propagations"])
+        if self._watchcalls % EXPCONFIG["solverRebootWindow"] != 0:
+            return
+        average = sum(self._watchrecent) / len(self._watchrecent)
+        if self._watchbaseline is None:
+            self._watchbaseline = max(average, 1)
+        elif (
+                self._watchconflicts > EXPCONFIG["solverRebootLearnts"]
+                and average > EXPCONFIG["solverRebootSlowdown"] * self._watchbaseline
+        ):
+            logging.info(
+                "Rebooting solver: %s conflicts in %s calls, propagations per call %s -> %s",
+                self._watchconflicts,
+                self._watchcalls,
+                self._watchbaseline,
+                average,
+            )
+            self._stats["reboots"] += 1
+            # Don't reboot yet, we still want the model / core of this solve
+            self._needreboot = True
+
     def dumpSAT(self, filename, assume):
         assert len(assume) == 1
         known = SortedSet(list(self._knownlits) + assume)
@@ -104,14 +225,18 @@ class SATSolver:
         #    print("!! solving in the main thread")
         #    traceback.print_stack()
 
+        if self._needreboot:
+            self.reboot()
         start_time = get_cpu_time()
-        x = self._solver.solve(assumptions=chainlist(lits, self._knownlits))
+        start_stats = self._solver.accum_stats()
+        x = self._solver.solve(assumptions=lits)
         end_time = get_cpu_time()
         self._stats["solveCount"] += 1
         self._stats["solveTime"] += end_time - start_time
         self._lasttime = end_time - start_time
         if self._lasttime > 5:
             logging.info("Long time solve: %s %s", len(lits), end_time - start_time)
+        self._watchSolve(start_stats)
         if getsol == False:
             return x
         if x:
@@ -119,18 +244,45 @@ class SATSolver:
         else:
             return None
 
-    def solveLimited(self, lits):
+    # The propagation budget for solveLimited, based on how much work recent
+    # searches on this instance needed
+    def propBudget(self):
+        if len(self._recentprops) == 0:
+            return EXPCONFIG["solveLimitedBudget"]
+        average = sum(self._recentprops) / len(self._recentprops)
+        return int(
+            min(
+                max(average * EXPCONFIG["solveLimitedBudgetMult"], EXPCONFIG["solveLimitedBudget"]),
+                EXPCONFIG["solveLimitedBudgetMax"],
+            )
+        )
+
+    # Returns True (sat), False (unsat) or None (ran out of budget).
+    # If 'escalate' is True, use the largest budget.
+    def solveLimited(self, lits, *, escalate=False):
         # if multiprocessing.current_process().name == "MainProcess":
         #    print("!! solveLimited in the main thread")
         #    traceback.print_stack()
 
+        if self._needreboot:
+            self.reboot()
         start_time = get_cpu_time()
         start_stats = self._solver.accum_stats()
         if EXPCONFIG["solveLimited"]:
-            self._solver.prop_budget(EXPCONFIG["solveLimitedBudget"])
-            x = self._solver.solve_limited(assumptions=chainlist(lits, self._knownlits))
+            if escalate:
+                self._solver.prop_budget(EXPCONFIG["solveLimitedBudgetMax"])
+            else:
+                self._solver.prop_budget(self.propBudget())
+            x = self._solver.solve_limited(assumptions=lits)
+            if x is None:
+                self._stats["solveUnknown"] += 1
+            else:
+                props = self._solver.accum_stats()["propagations"] - start_stats["propagations"]
+                self._recentprops.append(props)
+                if escalate:
+                    self._stats["solveRecovered"] += 1
         else:
-            x = self._solver.solve(assumptions=chainlist(lits, self._knownlits))
+            x = self._solver.solve(assumptions=lits)
         end_time = get_cpu_time()
         self._stats["solveCount"] += 1
         self._stats["solveTime"] += end_time - start_time
@@ -139,44 +291,91 @@ class SATSolver:
             logging.info(
                 "Long time solveLimited: %s %s", len(lits), end_time - start_time
             )
+        self._watchSolve(start_stats)
         return x
 
     def solveSingle(self, puzlits, lits):
         # if multiprocessing.current_process().name == "MainProcess":
         #    print("!! solveSingle in the main thread")
-        # We just brute force check all assignments to other variables
         sol = self.solve(lits, getsol=True)
         if sol is None:
             return []
-        for p in puzlits:
-            if sol[p]:
-                extrasol = self.solve(chainlist(lits, [-p]), getsol=False)
-                if extrasol:
-                    return [sol, self.solve(chainlist(lits, [-p]), getsol=True)]
-            else:
-                extrasol = self.solve(chainlist(lits, [p]), getsol=False)
-                if extrasol:
-                    return [sol, self.solve(chainlist(lits, [p]), getsol=True)]
+        # Block this solution, with a clause which at least one of 'puzlits'
+        # must disagree with. The clause is guarded by a fresh selector, which
+        # is assumed for this one solve and then permanently disabled. It is
+        # not added to _clauses, so it disappears when the solver reboots.
+        selector = self.Bool("block")
+        self._solver.add_clause([-selector] + [-p if sol[p] else p for p in puzlits])
+        extrasol = self.solve(chainlist(lits, [selector]), getsol=True)
+        self._solver.add_clause([-selector])
+        if extrasol is not None:
+            return [sol, extrasol]
         return [sol]
 
+    # Find the backbone of 'puzlits' (the values they take in every solution)
+    # under 'lits'. Returns a map from each backbone variable to its value,
+    # or None if there is no solution.
     def solveAll(self, puzlits, lits):
-        # if multiprocessing.current_process().name == "MainProcess":
-        #    print("!! solveSingle in the main thread")
-        # We just brute force check all assignments to other variables
-        sol = {}
-        for p in puzlits:
-            pos = self.solve(chainlist(lits, [p]), getsol=False)
-            neg = self.solve(chainlist(lits, [-p]), getsol=False)
-            if not (pos and neg):
-                if pos:
-                    sol[p] = True
-                else:
-                    sol[p] = False
-        return sol
+        sol = self.solve(lits, getsol=True)
+        if sol is None:
+            return None
+        candidates = [p if sol[p] else -p for p in puzlits]
+        return {abs(l): l > 0 for l in self.backbone(candidates, lits)}
+
+    # Return the literals in 'candidates' which are true in every solution
+    # under 'lits'. Every candidate must be true in some solution.
+    # We ask for a solution where at least one of the next 'chunk' candidates
+    # is false (with a clause guarded by a fresh selector, as in solveSingle).
+    # If there is none, the whole chunk is in the backbone. Otherwise the new
+    # solution rules out every candidate it falsifies, including at least one
+    # from the chunk.
+    def backbone(self, candidates, lits, chunk=None):
+        if chunk is None:
+            chunk = EXPCONFIG["backboneChunk"]
+        backbone = []
+        while len(candidates) > 0:
+            group = candidates[:chunk]
+            if len(group) == 1:
+                sol = self.solve(chainlist(lits, [-group[0]]), getsol=True)
+            else:
+                selector = self.Bool("backbone")
+                self._solver.add_clause([-selector] + [-l for l in group])
+                sol = self.solve(chainlist(lits, [selector]), getsol=True)
+                self._solver.add_clause([-selector])
+            if sol is None:
+                backbone.extend(group)
+                candidates = candidates[len(group):]
+            else:
+                candidates = [l for l in candidates if sol[abs(l)] == (l > 0)]
+        return backbone
+
+    # Unit propagate 'lits' (and the known literals). Returns (False, _) if
+    # this finds a conflict, otherwise (True, implied) where 'implied' lists
+    # the literals set by propagation, including 'lits'.
+    def propagate(self, lits):
+        if self._needreboot:
+            self.reboot()
+        self._stats["propagateCount"] += 1
+        return self._solver.propagate(assumptions=lits)
+
+    # Returns the model from the last solve, as a list where
+    # model[v-1] is v if v is true and -v if v is false
+    def model(self):
+        return self._solver.get_model()
+
+    # Map from each literal to the indices (in _clauses) of the clauses
+    # it occurs in
+    def occurrences(self):
+        if self._occurs is None:
+            self._occurs = {}
+            for (i, c) in enumerate(self._clauses):
+                for l in c:
+                    self._occurs.setdefault(l, []).append(i)
+        return self._occurs
 
     # Returns unsat_core from last solve
     def unsat_core(self):
-        core = [x for x in self._solver.get_core() if x not in self._knownlits]
+        core = self._solver.get_core()
         # logging.info("Core size: %s", len(core))
         return core
 
@@ -184,23 +383,38 @@ class SATSolver:
         self._stack.append(copy.deepcopy(self._knownlits))
 
     def pop(self):
-        self._knownlits = self._stack.pop()
+        knownlits = self._stack.pop()
+        if len(knownlits) != len(self._knownlits):
+            self._knownlits = knownlits
+            self._stats["popReboots"] += 1
+            self.reboot()
+
+    # Forget all the known literals, and rebuild the solver without them
+    def clearKnownLits(self):
+        self._knownlits = SortedSet()
+        self.reboot()
 
     def addLit(self, var):
         # We used to check this, but now one high-level variable can be named with multiple lits
         # assert var not in self._knownlits
         if var not in self._knownlits:
             self._knownlits.add(var)
+            self._solver.add_clause([var])
 
     def reset_stats(self):
         self._stats = {
             "solveCount": 0,
-            "solveTime": 0
+            "solveTime": 0,
+            "reboots": 0,
+            "popReboots": 0,
+            "solveUnknown": 0,
+            "solveRecovered": 0,
+            "propagateCount": 0,
         }
 
     def get_stats(self):
         return self._stats
 
     def add_stats(self, d):
-        self._stats["solveCount"] += d["solveCount"]
-        self._stats["solveTime"] += d["solveTime"]
+        for (k, v) in d.items():
+            self._stats[k] = self._stats.get(k, 0) + v
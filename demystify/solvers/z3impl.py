@@ -61,6 +61,10 @@ class Z3Solver:
         else:
             return [sol]
 
+    # Returns the model from the last solve
+    def model(self):
+        return self._solver.model()
+
     # Returns unsat_core from last solve
     def unsat_core(self):
         return self._solver.unsat_core()
@@ -76,7 +80,7 @@ class Z3Solver:
         self._solver.add(var)
 
 
-    def solveLimited(self, lits):
+    def solveLimited(self, lits, *, escalate=False):
         return self.solve(lits, getsol=False)
 
     # TODO: In SAT we do this to flush learned clauses
@@ -107,10 +107,31 @@ def randomFromSeed(seed):
     # return random.Random(seed)
 
 
+# A set of strings, which can quickly find which of them are a prefix of
+# another string, by looking up each prefix length
+class PrefixSet:
+    def __init__(self, words):
+        self._words = SortedSet(words)
+        self._lengths = sorted(set(len(w) for w in self._words))
+
+    def prefixesOf(self, n):
+        return [n[:l] for l in self._lengths if l <= len(n) and n[:l] in self._words]
+
+    def __iter__(self):
+        return iter(self._words)
+
+    def __repr__(self):
+        return repr(self._words)
+
+
 def parseSavileRowName(vars, auxvars, n):
-    varmatch = [v for v in vars if n.startswith(v)]
+    if not isinstance(vars, PrefixSet):
+        vars = PrefixSet(vars)
+    if not isinstance(auxvars, PrefixSet):
+        auxvars = PrefixSet(auxvars)
+    varmatch = vars.prefixesOf(n)
     if len(varmatch) == 0:
-        if not any(v for v in auxvars if n.startswith(v)):
+        if len(auxvars.prefixesOf(n)) == 0:
             print(
                 "Cannot find {} in the VAR list {} -- should it be AUX?".format(
                     n, vars
@@ -141,22 +162,6 @@ def parseSavileRowName(vars, auxvars, n):
     return (varmatch, tuple(args))
 
 
-def build_lit2conmap(clauses):
-    lit2conmap = dict()
-    for c in clauses:
-        for l in c:
-            if -l not in lit2conmap:
-                lit2conmap[-l] = SortedSet()
-            lit2conmap[-l].update(c)
-
-    # Blank out counts for variables in unit clauses
-    for c in clauses:
-        if len(c) == 1:
-            lit2conmap[c[0]] = SortedSet()
-            lit2conmap[-c[0]] = SortedSet()
-    return lit2conmap
-
-
 def build_lit2clausemap(clauses):
     litmap = dict()
     for c in clauses:
@@ -168,64 +173,114 @@ def build_lit2clausemap(clauses):
     return litmap
 
 
-# Check if this constraint is already known
-# We classify a constraint as 'known' if the clauses
-# it appears in are all the same as a pre-existing clause
-def checkConstraintAlreadyParsed(formula, con, name):
-    if not hasattr(formula, "lit2conmap"):
-        formula.lit2clausemap = build_lit2clausemap(formula.clauses)
-
-    lit2clausemap = formula.lit2clausemap
-
-    if not hasattr(formula, "concollection"):
-        formula.concollection = {}
+# Finds constraints which are the same as an earlier one. A constraint is
+# given by its SAT variable 'con', and is described by the clauses which
+# contain -con. Its signature is those clauses with con (and -con) renamed
+# to 1 (and -1), so two constraints with the same clauses over the same
+# other variables get the same signature. The map from literals to clauses
+# is built once, so checking all the constraints in a formula takes time
+# linear in its size.
+class ConstraintIndex:
+    def __init__(self, clauses):
+        self._lit2clausemap = build_lit2clausemap(clauses)
+        # Signature -> name of first constraint with it
+        self._seen = {}
+
+    # Returns None if 'con' is in no clauses
+    def signature(self, con):
+        if con not in self._lit2clausemap:
+            return None
+        # x*2 just to make sure we can use 1/-1 to normalise the constraint
+        return frozenset(
+            tuple(sorted(set(1 if x == con else -1 if x == -con else x * 2 for x in c)))
+            for c in self._lit2clausemap[con]
+        )
 
-    if con not in lit2clausemap:
-        logging.debug("Constraint never mentioned: %s", name)
-        return True
+    # Returns True if 'con' is never used, or is a duplicate, otherwise
+    # remembers it and returns False
+    def alreadyParsed(self, con, name):
+        sig = self.signature(con)
+        if sig is None:
+            logging.debug("Constraint never mentioned: %s", name)
+            return True
 
-    # Generate clauses, normalising the 'constraint' variable
-    logging.debug("Check: %s", lit2clausemap[con])
+        logging.debug("Check: %s %s", name, sig)
 
-    # x*2 just to make sure we can use 1/-1 to normalise the constraint
-    concpy = tuple(SortedSet(
-        [tuple(SortedSet([1 if x == con else -1 if x == -con else x * 2 for x in c])) for c in lit2clausemap[con]]))
+        if len(sig) == 0 or sig == {(-1, 1)}:
+            logging.debug("Constraint never used: %s", name)
+            return True
 
-    logging.debug("Check2: %s", concpy)
+        if sig in self._seen:
+            logging.info("duplicate found: %s = %s", name, self._seen[sig])
+            return True
+        self._seen[sig] = name
+        return False
 
-    if concpy == () or concpy == ((-1, 1),):
-        logging.debug("Constraint never used: %s", name)
-        return True
 
-    if concpy in formula.concollection:
-        logging.info("duplicate found: %s = %s", name, formula.concollection[concpy])
-        return True
-    else:
-        formula.concollection[concpy] = name
-        return False
+# Check if this constraint is already known
+# We classify a constraint as 'known' if the clauses
+# it appears in are all the same as a pre-existing clause
+def checkConstraintAlreadyParsed(formula, con, name):
+    if not hasattr(formula, "conindex"):
+        formula.conindex = ConstraintIndex(formula.clauses)
+    return formula.conindex.alreadyParsed(con, name)
+
+
+# For each constraint, finds the puzzle literals it is connected to. Two
+# literals are connected if they are in a clause together, and we follow
+# connections through literals which are not puzzle literals ('varlits')
+# or in a unit clause. Those literals are split into components with
+# union-find, and for each component we store the puzzle literals next
+# to it, so each constraint is then a single lookup.
+class ConnectedVarsIndex:
+    def __init__(self, clauses, varlits):
+        units = set(abs(c[0]) for c in clauses if len(c) == 1)
+        parent = {}
+
+        def find(x):
+            root = x
+            while parent[root] != root:
+                root = parent[root]
+            while parent[x] != root:
+                (parent[x], x) = (root, parent[x])
+            return root
+
+        def inner(c):
+            return [l for l in c if l not in varlits and abs(l) not in units]
+
+        for c in clauses:
+            lits = inner(c)
+            for l in lits:
+                parent.setdefault(l, l)
+            for l in lits[1:]:
+                (x, y) = (find(lits[0]), find(l))
+                if x != y:
+                    parent[y] = x
+
+        adjacent = {}
+        for c in clauses:
+            lits = inner(c)
+            if len(lits) > 0:
+                adjacent.setdefault(find(lits[0]), set()).update(l for l in c if l in varlits)
+
+        self._find = find
+        self._parent = parent
+        self._components = {root: SortedSet(lits) for (root, lits) in adjacent.items()}
+
+    # The puzzle literals connected to 'con'. Do not change the result,
+    # it is shared by all constraints in the same component.
+    def connected(self, con):
+        if -con not in self._parent:
+            return SortedSet()
+        return self._components.get(self._find(-con), SortedSet())
 
 
 def getConnectedVars(formula, con, varlits_in):
-    varlits = SortedSet(varlits_in.union([-v for v in varlits_in]))
-
-    if not hasattr(formula, "lit2conmap"):
-        formula.lit2conmap = build_lit2conmap(formula.clauses)
-
-    lit2conmap = formula.lit2conmap
-
-    if con not in lit2conmap:
-        return SortedSet()
-
-    found = SortedSet(lit2conmap[con])
-    todo = SortedSet()
-    for v in found:
-        if v not in varlits:
-            todo.add(v)
-    while len(todo) > 0:
-        val = todo.pop()
-        for v in lit2conmap[-val]:
-            if v not in found:
-                found.add(v)
-                if v not in varlits:
-                    todo.add(v)
-    return found.intersection(varlits)
+    # The index is built the first time, for these 'varlits'
+    (oldvarlits, index) = getattr(formula, "connectedindex", (None, None))
+    if index is None or oldvarlits is not varlits_in:
+        varlits = set(varlits_in)
+        varlits.update(-v for v in varlits_in)
+        index = ConnectedVarsIndex(formula.clauses, varlits)
+        formula.connectedindex = (varlits_in, index)
+    return index.connected(con)
@@ -0,0 +1,25 @@
+#!/usr/bin/env bash
+
+# Compare the SAT solver's incremental and non-incremental modes on the
+# instances in tests-cascade.txt. Results go in bench-incremental.txt.
+
+set -uo pipefail
+
+out=bench-incremental.txt
+mkdir -p outputs-bench
+echo "instance mode seconds reboots" > ${out}
+
+TIMEFORMAT=%R
+
+while read eprime param; do
+    for mode in plain incremental; do
+        flags=""
+        if [[ ${mode} == incremental ]]; then
+            flags="--incremental"
+        fi
+        filename=outputs-bench/$(basename ${eprime})-$(basename ${param})-${mode}
+        seconds=$( { time python3 ../demystify --cores 1 --info ${flags} --eprime ../eprime/${eprime} --eprimeparam ../eprime/${param} --json ${filename}.json > ${filename}.err 2>&1 ; } 2>&1 )
+        reboots=$(grep -o "'reboots': [0-9]*" ${filename}.err | tail -1 | cut -d' ' -f2)
+        echo "${eprime}:${param} ${mode} ${seconds} ${reboots:-?}" | tee -a ${out}
+    done
+done < tests-cascade.txt
@@ -73,9 +73,9 @@ print(f"{solver._varsmt2neglitmap=}")
 print(f"{solver._varsmt=}")
 print(f"{solver._knownlits=}")
 print(f"{solver._cnf=}")
-print(f"{solver._varlit2con=}")
-print(f"{solver._varlit2negconnectedlits=}")
-print(f"{solver._varlit2con2=}")
+print(f"{solver._litids=}")
+print(f"{solver._lit2conlits=}")
+print(f"{solver._con2lits=}")
 
 # Then we 'add' all the assignments that we know (this is what we can undo later with a 'pop')
 for s in sudokumodel: